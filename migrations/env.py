@@ -1,7 +1,9 @@
 import logging
+import os
 from logging.config import fileConfig
 
-from flask import current_app
+from flask import current_app, has_app_context
+from sqlalchemy import engine_from_config, pool
 
 from alembic import context
 
@@ -16,6 +18,11 @@ logger = logging.getLogger('alembic.env')
 
 
 def get_engine():
+    if not has_app_context():
+        return engine_from_config(
+            config.get_section(config.config_ini_section, {}),
+            prefix='sqlalchemy.',
+            poolclass=pool.NullPool)
     try:
         # this works with Flask-SQLAlchemy<3 and Alchemical
         return current_app.extensions['migrate'].db.get_engine()
@@ -36,8 +43,17 @@ def get_engine_url():
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-config.set_main_option('sqlalchemy.url', get_engine_url())
-target_db = current_app.extensions['migrate'].db
+if has_app_context():
+    # `flask db ...`: Flask-Migrate ya levantó la app
+    config.set_main_option('sqlalchemy.url', get_engine_url())
+    target_db = current_app.extensions['migrate'].db
+else:
+    # `alembic ...` directo: sin create_app() (ni blueprints ni engine de
+    # Flask-SQLAlchemy); solo hace falta la URL y el metadata de los modelos.
+    from proc_detracciones.models import db as target_db
+    if os.getenv('DATABASE_URL'):
+        config.set_main_option(
+            'sqlalchemy.url', os.environ['DATABASE_URL'].replace('%', '%%'))
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -90,7 +106,8 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
-    conf_args = current_app.extensions['migrate'].configure_args
+    conf_args = (current_app.extensions['migrate'].configure_args
+                 if has_app_context() else {})
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
 
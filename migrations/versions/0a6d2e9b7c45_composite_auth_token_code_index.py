@@ -0,0 +1,29 @@
+"""Replace auth_token.code index with a composite partial index
+
+Revision ID: 0a6d2e9b7c45
+Revises: f5a0b3c7d912
+Create Date: 2026-10-15 12:31:40.615029
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a6d2e9b7c45'
+down_revision = 'f5a0b3c7d912'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_auth_token_code')
+        batch_op.create_index('ix_auth_token_code_active', ['user_id', 'purpose', 'code'], unique=False,
+                              postgresql_where=sa.text('revoked = false'), sqlite_where=sa.text('revoked = 0'))
+
+
+def downgrade():
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_auth_token_code_active')
+        batch_op.create_index('ix_auth_token_code', ['code'], unique=False)
@@ -0,0 +1,79 @@
+"""Store auth_token.token_hash as raw 32-byte SHA-256
+
+Revision ID: 1b8e4f0a6d23
+Revises: 0a6d2e9b7c45
+Create Date: 2026-10-15 12:55:09.482176
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b8e4f0a6d23'
+down_revision = '0a6d2e9b7c45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_index('ix_auth_token_token_hash', table_name='auth_token')
+        op.execute("ALTER TABLE auth_token ALTER COLUMN token_hash TYPE bytea USING decode(token_hash, 'hex')")
+        op.create_index('ix_auth_token_token_hash', 'auth_token', ['token_hash'], unique=True)
+        return
+
+    # Otros motores (SQLite): columna nueva, copiar convirtiendo hex -> bytes y reemplazar
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token_hash_bin', sa.LargeBinary(length=32), nullable=True))
+
+    tokens = sa.table('auth_token',
+                      sa.column('id', sa.Integer),
+                      sa.column('token_hash', sa.String),
+                      sa.column('token_hash_bin', sa.LargeBinary))
+    rows = bind.execute(sa.select(tokens.c.id, tokens.c.token_hash)).all()
+    if rows:
+        bind.execute(
+            tokens.update().where(tokens.c.id == sa.bindparam('_id')).values(token_hash_bin=sa.bindparam('_bin')),
+            [{'_id': r.id, '_bin': bytes.fromhex(r.token_hash)} for r in rows],
+        )
+
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_auth_token_token_hash')
+        batch_op.drop_column('token_hash')
+        batch_op.alter_column('token_hash_bin', new_column_name='token_hash',
+                              existing_type=sa.LargeBinary(length=32), nullable=False)
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.create_index('ix_auth_token_token_hash', ['token_hash'], unique=True)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_index('ix_auth_token_token_hash', table_name='auth_token')
+        op.execute("ALTER TABLE auth_token ALTER COLUMN token_hash TYPE varchar(128) USING encode(token_hash, 'hex')")
+        op.create_index('ix_auth_token_token_hash', 'auth_token', ['token_hash'], unique=True)
+        return
+
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token_hash_hex', sa.String(length=128), nullable=True))
+
+    tokens = sa.table('auth_token',
+                      sa.column('id', sa.Integer),
+                      sa.column('token_hash', sa.LargeBinary),
+                      sa.column('token_hash_hex', sa.String))
+    rows = bind.execute(sa.select(tokens.c.id, tokens.c.token_hash)).all()
+    if rows:
+        bind.execute(
+            tokens.update().where(tokens.c.id == sa.bindparam('_id')).values(token_hash_hex=sa.bindparam('_hex')),
+            [{'_id': r.id, '_hex': bytes(r.token_hash).hex()} for r in rows],
+        )
+
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_auth_token_token_hash')
+        batch_op.drop_column('token_hash')
+        batch_op.alter_column('token_hash_hex', new_column_name='token_hash',
+                              existing_type=sa.String(length=128), nullable=False)
+    with op.batch_alter_table('auth_token', schema=None) as batch_op:
+        batch_op.create_index('ix_auth_token_token_hash', ['token_hash'], unique=True)
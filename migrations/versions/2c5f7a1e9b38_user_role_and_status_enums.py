@@ -0,0 +1,49 @@
+"""Store user.role and user.account_status as enums
+
+Revision ID: 2c5f7a1e9b38
+Revises: 1b8e4f0a6d23
+Create Date: 2026-10-15 13:24:47.051893
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '2c5f7a1e9b38'
+down_revision = '1b8e4f0a6d23'
+branch_labels = None
+depends_on = None
+
+
+ROLES = ('user', 'admin')
+STATUSES = ('TRIAL_ACTIVO', 'TRIAL_VENCIDO', 'PENDIENTE_VERIFICACION', 'PENDIENTE_PAGO',
+            'PENDIENTE_REVISION', 'ACTIVO', 'SUSPENDIDO')
+
+
+def upgrade():
+    # Solo Postgres tiene ENUM nativo; en SQLite el Enum sigue siendo VARCHAR
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    postgresql.ENUM(*ROLES, name='role_enum').create(op.get_bind(), checkfirst=True)
+    postgresql.ENUM(*STATUSES, name='account_status_enum').create(op.get_bind(), checkfirst=True)
+    op.execute('ALTER TABLE "user" ALTER COLUMN role DROP DEFAULT')
+    op.execute('ALTER TABLE "user" ALTER COLUMN role TYPE role_enum USING role::role_enum')
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status DROP DEFAULT')
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status TYPE account_status_enum '
+               'USING account_status::account_status_enum')
+    # El default de 97972bb54241 no se puede castear solo: se quita y se repone
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status '
+               "SET DEFAULT 'TRIAL_ACTIVO'::account_status_enum")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE "user" ALTER COLUMN role TYPE varchar(20) USING role::text')
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status DROP DEFAULT')
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status TYPE varchar(24) USING account_status::text')
+    op.execute('ALTER TABLE "user" ALTER COLUMN account_status SET DEFAULT \'TRIAL_ACTIVO\'')
+    postgresql.ENUM(name='account_status_enum').drop(op.get_bind(), checkfirst=True)
+    postgresql.ENUM(name='role_enum').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,26 @@
+"""Add (account_status, created_at) index on user
+
+Revision ID: 3d9f1c6b2e70
+Revises: 2c5f7a1e9b38
+Create Date: 2026-10-15 13:52:10.418276
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d9f1c6b2e70'
+down_revision = '2c5f7a1e9b38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index('ix_user_status_created', ['account_status', 'created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_status_created')
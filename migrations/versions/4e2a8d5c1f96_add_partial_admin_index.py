@@ -0,0 +1,27 @@
+"""Add partial index on admin users
+
+Revision ID: 4e2a8d5c1f96
+Revises: 3d9f1c6b2e70
+Create Date: 2026-10-15 14:06:33.902417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e2a8d5c1f96'
+down_revision = '3d9f1c6b2e70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index('ix_user_admin', ['id'], unique=False,
+                              postgresql_where=sa.text("role = 'admin'"), sqlite_where=sa.text("role = 'admin'"))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_admin')
@@ -0,0 +1,49 @@
+"""ON DELETE CASCADE / SET NULL on foreign keys to user
+
+Revision ID: 5f7b3e0a9c18
+Revises: 4e2a8d5c1f96
+Create Date: 2026-10-15 14:31:05.627140
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f7b3e0a9c18'
+down_revision = '4e2a8d5c1f96'
+branch_labels = None
+depends_on = None
+
+
+# (tabla, nombre de la FK, columna, tabla referida, ON DELETE)
+FKS = (
+    ('user_plan_subscription', 'user_plan_subscription_user_id_fkey', 'user_id', 'user', 'CASCADE'),
+    ('user_plan_subscription', 'user_plan_subscription_created_by_admin_id_fkey', 'created_by_admin_id', 'user', 'SET NULL'),
+    ('user_plan_subscription_counter', 'user_plan_subscription_counter_sub_id_fkey', 'sub_id', 'user_plan_subscription', 'CASCADE'),
+    ('service_usage_log', 'service_usage_log_user_id_fkey', 'user_id', 'user', 'CASCADE'),
+    ('service_error_log', 'service_error_log_usage_log_id_fkey', 'usage_log_id', 'service_usage_log', 'CASCADE'),
+    ('auth_token', 'auth_token_user_id_fkey', 'user_id', 'user', 'SET NULL'),
+    ('user', 'fk_user_payment_reviewed_by_admin', 'payment_reviewed_by_admin_id', 'user', 'SET NULL'),
+)
+
+
+def _recreate(with_ondelete):
+    for table, name, column, referent, ondelete in FKS:
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referent, [column], ['id'],
+                              ondelete=ondelete if with_ondelete else None)
+
+
+def upgrade():
+    # SQLite no aplica FKs (no se activa PRAGMA foreign_keys): ahí delete_user
+    # limpia a mano y recrear las tablas en batch no aporta nada
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    _recreate(with_ondelete=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    _recreate(with_ondelete=False)
@@ -0,0 +1,36 @@
+"""Add trigram index for the admin user search
+
+Revision ID: 6a1c4f8e2d57
+Revises: 5f7b3e0a9c18
+Create Date: 2026-10-15 14:52:41.180936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a1c4f8e2d57'
+down_revision = '5f7b3e0a9c18'
+branch_labels = None
+depends_on = None
+
+
+# Debe coincidir con User.search_text para que el planner use el índice
+SEARCH_TEXT = ("(coalesce(email, '') || ' ' || coalesce(username, '') || ' ' || "
+               "coalesce(first_name, '') || ' ' || coalesce(last_name, ''))")
+
+
+def upgrade():
+    # pg_trgm es de Postgres; en SQLite el ILIKE sigue recorriendo la tabla
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_user_search_trgm', 'user', [sa.text(f'{SEARCH_TEXT} gin_trgm_ops')],
+                    unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_user_search_trgm', table_name='user')
@@ -0,0 +1,38 @@
+"""Drop xml_processed from the usage log index
+
+Revision ID: 7b2d5e9f3a61
+Revises: 6a1c4f8e2d57
+Create Date: 2026-10-15 16:08:27.402913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2d5e9f3a61'
+down_revision = '6a1c4f8e2d57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # El SUM de xml_processed ya no se hace (lo lleva el contador de la
+    # suscripción): la columna solo encarecía cada INSERT del log
+    with op.batch_alter_table('service_usage_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_usage_user_svc_completed')
+        batch_op.create_index(
+            'ix_usage_user_svc_completed',
+            ['user_id', 'service_id', 'completed_at'],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('service_usage_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_usage_user_svc_completed')
+        batch_op.create_index(
+            'ix_usage_user_svc_completed',
+            ['user_id', 'service_id', 'completed_at', 'xml_processed'],
+            unique=False,
+        )
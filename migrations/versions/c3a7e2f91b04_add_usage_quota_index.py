@@ -0,0 +1,30 @@
+"""Add covering index for quota usage sum
+
+Revision ID: c3a7e2f91b04
+Revises: e19315d30ab8
+Create Date: 2026-10-15 10:12:04.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a7e2f91b04'
+down_revision = 'e19315d30ab8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('service_usage_log', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_usage_user_svc_completed',
+            ['user_id', 'service_id', 'completed_at', 'xml_processed'],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('service_usage_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_usage_user_svc_completed')
@@ -0,0 +1,44 @@
+"""Add per-subscription usage counter
+
+Revision ID: d84b1e6c2a57
+Revises: c3a7e2f91b04
+Create Date: 2026-10-15 11:03:27.540912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd84b1e6c2a57'
+down_revision = 'c3a7e2f91b04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_plan_subscription_counter',
+    sa.Column('sub_id', sa.Integer(), nullable=False),
+    sa.Column('service_id', sa.Integer(), nullable=False),
+    sa.Column('xml_used', sa.Integer(), nullable=False),
+    sa.Column('runs_used', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['service_id'], ['service.id'], ),
+    sa.ForeignKeyConstraint(['sub_id'], ['user_plan_subscription.id'], ),
+    sa.PrimaryKeyConstraint('sub_id', 'service_id')
+    )
+
+    # Backfill: mismo criterio que el SUM que reemplaza (logs del usuario
+    # completados desde el inicio de cada suscripción)
+    op.execute("""
+        INSERT INTO user_plan_subscription_counter (sub_id, service_id, xml_used, runs_used, updated_at)
+        SELECT s.id, l.service_id, COALESCE(SUM(l.xml_processed), 0), COUNT(l.id), CURRENT_TIMESTAMP
+        FROM user_plan_subscription s
+        JOIN service_usage_log l
+          ON l.user_id = s.user_id AND l.completed_at >= s.starts_at
+        GROUP BY s.id, l.service_id
+    """)
+
+
+def downgrade():
+    op.drop_table('user_plan_subscription_counter')
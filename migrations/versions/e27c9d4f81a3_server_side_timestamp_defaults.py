@@ -0,0 +1,47 @@
+"""Server-side CURRENT_TIMESTAMP defaults for audit timestamps
+
+Revision ID: e27c9d4f81a3
+Revises: d84b1e6c2a57
+Create Date: 2026-10-15 11:41:52.903318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e27c9d4f81a3'
+down_revision = 'd84b1e6c2a57'
+branch_labels = None
+depends_on = None
+
+
+# (tabla, columna, nullable) que pasan a DEFAULT CURRENT_TIMESTAMP
+COLUMNS = [
+    ('user', 'created_at', False),
+    ('auth_token', 'created_at', False),
+    ('plan', 'created_at', True),
+    ('service', 'created_at', True),
+    ('user_plan_subscription', 'created_at', True),
+    ('user_plan_subscription_counter', 'updated_at', True),
+    ('service_usage_log', 'started_at', True),
+    ('service_error_log', 'occurred_at', True),
+]
+
+
+def upgrade():
+    for table, column, nullable in COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(column,
+                   existing_type=sa.DateTime(timezone=True),
+                   existing_nullable=nullable,
+                   server_default=sa.text('CURRENT_TIMESTAMP'))
+
+
+def downgrade():
+    for table, column, nullable in COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(column,
+                   existing_type=sa.DateTime(timezone=True),
+                   existing_nullable=nullable,
+                   server_default=None)
@@ -0,0 +1,30 @@
+"""Add partial indexes for active subscriptions
+
+Revision ID: f5a0b3c7d912
+Revises: e27c9d4f81a3
+Create Date: 2026-10-15 12:08:15.277604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5a0b3c7d912'
+down_revision = 'e27c9d4f81a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user_plan_subscription', schema=None) as batch_op:
+        batch_op.create_index('ix_ups_user_active_endsat', ['user_id', 'ends_at'], unique=False,
+                              postgresql_where=sa.text('is_active = true'), sqlite_where=sa.text('is_active = 1'))
+        batch_op.create_index('ix_ups_user_active_created', ['user_id', 'created_at'], unique=False,
+                              postgresql_where=sa.text('is_active = true'), sqlite_where=sa.text('is_active = 1'))
+
+
+def downgrade():
+    with op.batch_alter_table('user_plan_subscription', schema=None) as batch_op:
+        batch_op.drop_index('ix_ups_user_active_created')
+        batch_op.drop_index('ix_ups_user_active_endsat')
@@ -1,69 +1,63 @@
-# proc_detracciones/__init__.py
-from datetime import datetime, timezone
-from zoneinfo import ZoneInfo
-
-from flask import Flask, flash, redirect, request, url_for, current_app
-from .config import Config
-from .extensions import db, login_manager
-from .commands import register_cli
-
-from proc_detracciones.extensions import db, migrate
-
-
 # proc_detracciones/__init__.py
 import os
+import tempfile
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import timedelta, timezone
 from zoneinfo import ZoneInfo
 
-from flask import Flask, flash, redirect, request, url_for, current_app
+from flask import Flask, Request, Response, flash, redirect, request, session, url_for, current_app
+from sqlalchemy.orm import defer
 
-# CARGAR .env ANTES DE IMPORTAR Config
+# CARGAR .env ANTES DE IMPORTAR Config (una sola vez; no pisa variables ya definidas)
 from dotenv import load_dotenv
 
 # Buscar .env en la raíz del proyecto (un nivel arriba de este archivo)
 env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
-
-import os
-from pathlib import Path
-from datetime import datetime, timezone
-from zoneinfo import ZoneInfo
-
-from flask import Flask, flash, redirect, request, url_for, current_app
-from dotenv import load_dotenv
-
-
-
-
-
-
-# Buscar .env en la raíz del proyecto
-env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
+load_dotenv(env_path, override=False)
 
-# DEBUG: Imprimir INMEDIATAMENTE después de cargar
-print("=" * 60)
-print(f"[INIT] .env path: {env_path}")
-print(f"[INIT] .env exists: {env_path.exists()}")
-print(f"[INIT] MAIL_USERNAME desde os.getenv: {os.getenv('MAIL_USERNAME')}")
-print(f"[INIT] MAIL_PASSWORD desde os.getenv: {'***SET***' if os.getenv('MAIL_PASSWORD') else 'NOT SET'}")
-print("=" * 60)
+# DEBUG: solo con PROC_DEBUG_ENV=1, para no imprimir en cada arranque de worker
+if os.environ.get("PROC_DEBUG_ENV"):
+    print("=" * 60)
+    print(f"[INIT] .env path: {env_path}")
+    print(f"[INIT] .env exists: {env_path.exists()}")
+    print(f"[INIT] MAIL_USERNAME desde os.getenv: {os.getenv('MAIL_USERNAME')}")
+    print(f"[INIT] MAIL_PASSWORD desde os.getenv: {'***SET***' if os.getenv('MAIL_PASSWORD') else 'NOT SET'}")
+    print("=" * 60)
 
+# Ahora sí importar Config (que ya podrá leer las variables)
+from .config import Config
+from .extensions import db, login_manager, migrate, compress, now_utc
+from .commands import register_cli
+from .models import User
+from .routes.auth import auth_bp
+from .routes.home import home_bp
+from .routes.detracciones import detracciones_bp
+from .routes.admin import admin_bp
+from .services.procesador import warmup
 
 
+# Endpoints que el guard del trial no bloquea (login/registro y archivos estáticos)
+_TRIAL_EXEMPT_ENDPOINTS = frozenset({"static"})
+_TRIAL_EXEMPT_PREFIXES = ("auth.",)
 
 
-# Ahora sí importar Config (que ya podrá leer las variables)
-from .config import Config
-from .extensions import db, login_manager, migrate
-from .commands import register_cli
+class UploadRequest(Request):
+    """
+    Cada parte de archivo del multipart se guarda en su propio
+    SpooledTemporaryFile: los XML sueltos (pocos KB) quedan en RAM y se
+    escriben una sola vez al directorio de trabajo; lo que pase de
+    spool_max_size (ZIPs) se vuelca a disco con buffer de 1 MiB.
+    """
+    spool_max_size = 256 * 1024
 
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=self.spool_max_size, mode="wb+", buffering=1024 * 1024)
 
 
 def create_app():
     app = Flask(__name__)
-    app.config.from_object(Config())
+    app.request_class = UploadRequest
+    app.config.from_object(Config)
 
     # ─────────────────────────────────────────────────────────────────────────────
     # [A] AJUSTES DEL TRIAL (PERÍODO DE PRUEBA)
@@ -80,6 +74,11 @@ def create_app():
     app.config.setdefault("TRIAL_SECONDS", 0)
     app.config.setdefault("TRIAL_ENDS_BY", "both")       # "date" | "quota" | "both"
     app.config.setdefault("TRIAL_TZ", "America/Lima")    # Zona horaria para mostrar
+    # Se resuelve una sola vez; hooks y vistas la leen de app.extensions
+    try:
+        app.extensions["trial_tz"] = ZoneInfo(app.config["TRIAL_TZ"])
+    except Exception:
+        app.extensions["trial_tz"] = timezone.utc
 
     # ─────────────────────────────────────────────────────────────────────────────
     # [B] CUOTAS DE USO DURANTE EL TRIAL
@@ -100,6 +99,25 @@ def create_app():
     app.config.setdefault("MAGIC_TOKEN_TTL_SECONDS", 0)  # para pruebas
     app.config.setdefault("MAGIC_TOKEN_TTL_HOURS", 6)      # si usas horas, pon >0 y deja SECONDS=0
 
+    # [A]-[C] ya resueltos a int/timedelta: la config no cambia en runtime y así
+    # auth/CLI no repiten get + int() en cada link o usuario creado.
+    trial_delta = timedelta(
+        seconds=int(app.config["TRIAL_SECONDS"] or 0),
+        minutes=int(app.config["TRIAL_MINUTES"] or 0),
+        hours=int(app.config["TRIAL_HOURS"] or 0),
+        days=int(app.config["TRIAL_DAYS"] or 0),
+    )
+    if trial_delta.total_seconds() <= 0:
+        trial_delta = timedelta(days=int(app.config["TRIAL_DAYS"] or 0))
+    ttl_secs = int(app.config["MAGIC_TOKEN_TTL_SECONDS"] or 0)
+    app.extensions["trial_defaults"] = {
+        "xml": int(app.config["TRIAL_XML_QUOTA"]),
+        "runs": int(app.config["TRIAL_RUNS_QUOTA"]),
+        "trial_delta": trial_delta,
+        "token_ttl": (timedelta(seconds=ttl_secs) if ttl_secs > 0
+                      else timedelta(hours=int(app.config["MAGIC_TOKEN_TTL_HOURS"] or 0))),
+    }
+
     # ─────────────────────────────────────────────────────────────────────────────
     # [D] LÍMITES DE SUBIDA / UI
     # - MAX_CONTENT_LENGTH: tope del request en Flask (tamaño total, bytes).
@@ -108,6 +126,49 @@ def create_app():
     # ─────────────────────────────────────────────────────────────────────────────
     app.config.setdefault("MAX_CONTENT_LENGTH", 7 * 1024 * 1024)  # 7 MB server-side
     app.config.setdefault("WEB_MAX_XML_PER_UPLOAD", 500)           # límite suave por envío
+    # Campos de texto del form (lote, tipo, token) en RAM: con 64 KB sobra.
+    # Los archivos no cuentan aquí: se guardan aparte (ver UploadRequest).
+    app.config.setdefault("MAX_FORM_MEMORY_SIZE", 64 * 1024)
+
+    # ─────────────────────────────────────────────────────────────────────────────
+    # [D.1] PROCESAMIENTO
+    # - PIPELINE_WORKERS: procesos para parsear XML en paralelo dentro de
+    #   run_pipeline (1 = sin paralelismo, por defecto). Opt-in: cada worker de
+    #   gunicorn levanta su propio pool (forkserver), limitado a sus CPUs.
+    #   Solo se usa en lotes grandes.
+    # ─────────────────────────────────────────────────────────────────────────────
+    app.config.setdefault("PIPELINE_WORKERS", int(os.getenv("PIPELINE_WORKERS", "1")))
+    # - SCRATCH_DIR: dónde se crea el directorio de trabajo de cada request.
+    #   /dev/shm (tmpfs, en RAM) si existe; None = el temp por defecto (/tmp).
+    app.config.setdefault("SCRATCH_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+    # - RESULT_ZIP_COMPRESS: False = ZIP de resultado sin comprimir (ZIP_STORED,
+    #   TXT + CSV pesan pocos KB). True = ZIP_DEFLATED nivel 1, para lotes
+    #   grandes: ~5x menos CPU que el nivel por defecto y casi el mismo ratio.
+    app.config.setdefault("RESULT_ZIP_COMPRESS", False)
+
+    # ─────────────────────────────────────────────────────────────────────────────
+    # [D.2] COMPRESIÓN DE RESPUESTAS
+    # - Solo el HTML (páginas Jinja) se comprime con gzip/brotli según
+    #   Accept-Encoding. El ZIP de resultado ya va empaquetado y no se toca.
+    # ─────────────────────────────────────────────────────────────────────────────
+    app.config.setdefault("COMPRESS_MIMETYPES", ["text/html"])
+    app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+
+    # ─────────────────────────────────────────────────────────────────────────────
+    # [D.3] POOL DE CONEXIONES A LA BD
+    # - pool_pre_ping: descarta conexiones que el servidor cerró (idle timeout)
+    #   antes de usarlas, en vez de fallar la request.
+    # - En Postgres: DB_POOL conexiones por worker (por defecto 4, una por hilo
+    #   de gunicorn --threads 4), sin overflow, recicladas cada 5 min y en LIFO
+    #   para que las calientes sean las que se reusan. SQLite usa su propio pool.
+    # ─────────────────────────────────────────────────────────────────────────────
+    engine_opts = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    engine_opts.setdefault("pool_pre_ping", True)
+    if not str(app.config.get("SQLALCHEMY_DATABASE_URI", "")).startswith("sqlite"):
+        engine_opts.setdefault("pool_size", int(os.getenv("DB_POOL", "4")))
+        engine_opts.setdefault("max_overflow", 0)
+        engine_opts.setdefault("pool_recycle", 300)
+        engine_opts.setdefault("pool_use_lifo", True)
 
     # ─────────────────────────────────────────────────────────────────────────────
     # [E] URLS Y ESQUEMA
@@ -123,34 +184,41 @@ def create_app():
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
+    compress.init_app(app)
 
     # Blueprints
-    # Blueprints
-    from .routes.auth import auth_bp
-    from .routes.home import home_bp
-    from .routes.detracciones import detracciones_bp  # ← Cambiar esta línea
-
-
-
-
     app.register_blueprint(auth_bp)
     app.register_blueprint(home_bp)
-    app.register_blueprint(detracciones_bp)  # ← Y esta
+    app.register_blueprint(detracciones_bp)
+    app.register_blueprint(admin_bp)
 
     # CLI
     register_cli(app)
 
-    
-    from proc_detracciones.routes.admin import admin_bp
-    app.register_blueprint(admin_bp)
-    
-    # DB + user_loader
-    with app.app_context():
-        from .models import User, AuthToken
+    # Precalentar el parser de XML una sola vez (con gunicorn --preload ocurre
+    # en el master, antes de forkear). En debug se omite para no frenar el reloader.
+    if not app.debug:
+        warmup()
+
+    # user_loader
+    @login_manager.user_loader
+    def load_user(user_id: str):
+        # session.get mira primero el identity map antes de ir a la DB.
+        # El hash solo se usa en login y cambio de clave: se carga recién si
+        # se lee (la URL del comprobante ya es diferida en el modelo).
+        return db.session.get(
+            User, int(user_id),
+            options=[defer(User.password_hash)],
+        )
 
-        @login_manager.user_loader
-        def load_user(user_id: str):
-            return User.query.get(int(user_id))
+    # ─────────────────────────────────────────────────────────────────────────────
+    # Health check (Railway/Render): responde antes que cualquier otro hook, sin
+    # cargar el usuario ni tocar la DB. Debe registrarse antes del guard del trial.
+    # ─────────────────────────────────────────────────────────────────────────────
+    @app.before_request
+    def _healthz():
+        if request.path == "/healthz":
+            return Response(b"ok", mimetype="text/plain")
 
     # ─────────────────────────────────────────────────────────────────────────────
     # Guard global: si el TRIAL venció, cierra sesión y redirige a /auth/login
@@ -158,11 +226,17 @@ def create_app():
     # ─────────────────────────────────────────────────────────────────────────────
     @app.before_request
     def _enforce_trial_expiry():
+        # Visitante anónimo: sin sesión ni cookie "recordarme" no hay usuario
+        # que cargar; salir antes de que current_user dispare load_user.
+        if "_user_id" not in session and not request.cookies.get(
+            current_app.config.get("REMEMBER_COOKIE_NAME", "remember_token")
+        ):
+            return
         from flask_login import current_user, logout_user
         if not getattr(current_user, "is_authenticated", False):
             return
         ep = (request.endpoint or "")
-        if ep.startswith("auth.") or ep == "static":
+        if ep in _TRIAL_EXEMPT_ENDPOINTS or ep.startswith(_TRIAL_EXEMPT_PREFIXES):
             return
 
         ends = getattr(current_user, "trial_ends_at", None)
@@ -172,9 +246,8 @@ def create_app():
         if ends.tzinfo is None:
             ends = ends.replace(tzinfo=timezone.utc)
 
-        if datetime.now(timezone.utc) > ends:
-            tz = ZoneInfo(current_app.config.get("TRIAL_TZ", "America/Lima"))
-            msg_time = ends.astimezone(tz).strftime("%Y-%m-%d %H:%M:%S %Z")
+        if now_utc() > ends:
+            msg_time = ends.astimezone(current_app.extensions["trial_tz"]).strftime("%Y-%m-%d %H:%M:%S %Z")
             logout_user()
             flash(f"Tu período de prueba venció el {msg_time}.", "warning")
             return redirect(url_for("auth.login"))
@@ -6,14 +6,19 @@ import random
 import click
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from sqlalchemy import select, or_, and_
+from sqlalchemy import select, update, func
 
 from .extensions import db
-from .models import User
-from .routes.auth import create_magic_link
+from .models import User, ServiceUsageLog, AuthToken, UserPlanSubscriptionCounter
+from .routes.auth import create_magic_link, create_trial_users_bulk
+from .routes.detracciones import DETRACCIONES_SERVICE_ID
 
 
 # ───────────────────────── Helpers ─────────────────────────
+_LIMA_TZ = ZoneInfo("America/Lima")
+# Ventana en la que repetir trial:invite para el mismo ident devuelve el mismo link
+_INVITE_REUSE_WINDOW = timedelta(seconds=30)
+
 def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
@@ -22,33 +27,111 @@ def _fmt_lima(dt) -> str:
         return "-"
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(ZoneInfo("America/Lima")).strftime("%d/%m/%Y - %H:%M:%S")
+    # Formato armado a mano: evita el parser de strftime en cada fila del listado
+    d = dt.astimezone(_LIMA_TZ)
+    return f"{d.day:02d}/{d.month:02d}/{d.year} - {d.hour:02d}:{d.minute:02d}:{d.second:02d}"
 
 def _find_user(ident: str):
-    stmt = select(User).where(or_(User.email == ident, User.username == ident))
-    return db.session.execute(stmt).scalar_one_or_none()
+    # Igual que auth._find_user_by_ident: con "@" es email, si no username.
+    # Así cada consulta usa su índice en vez de un OR entre columnas.
+    col = User.email if "@" in ident else User.username
+    u = db.session.execute(select(User).where(col == ident)).scalar_one_or_none()
+    if u is None and col is User.email:
+        # username con "@" (caso raro): segundo intento por username
+        u = db.session.execute(select(User).where(User.username == ident)).scalar_one_or_none()
+    return u
+
+def _recent_invite_link(ident: str):
+    """Link de un invite_trial recién emitido por la CLI y aún sin usar, si existe."""
+    u = _find_user(ident)
+    if u is None:
+        return None
+    return db.session.execute(
+        select(AuthToken.magic_link_url)
+        .where(
+            AuthToken.user_id == u.id,
+            AuthToken.purpose == "invite_trial",
+            AuthToken.revoked.is_(False),
+            AuthToken.used_count == 0,
+            AuthToken.magic_link_url.is_not(None),
+            AuthToken.created_at >= _utcnow() - _INVITE_REUSE_WINDOW,
+        )
+        .order_by(AuthToken.id.desc())
+        .limit(1)
+    ).scalar_one_or_none()
+
+def _remember_invite_link(token: AuthToken, link: str) -> None:
+    # Igual que admin: guardar el link completo en el token recién emitido
+    token.magic_link_url = link
+    db.session.commit()
+
+def _update_user(user_id: int, **fields) -> None:
+    """UPDATE directo de columnas de User (sin flush del objeto ORM) + commit."""
+    if fields:
+        db.session.execute(update(User).where(User.id == user_id).values(**fields))
+    db.session.commit()
+
+def _gen_usernames(count: int, prefix: str = "user", digits: int = 4) -> list[str]:
+    """Genera `count` usernames userNNNN distintos y libres."""
+    lo, hi = 10**(digits-1), 10**digits - 1
+    if count > hi - lo + 1:
+        raise click.ClickException(f"No hay {count} usernames posibles con {digits} dígitos.")
+    found = set()
+    for _ in range(100):
+        # Un solo SELECT por tanda de candidatos en vez de uno por intento
+        batch = max(16, 2 * (count - len(found)))
+        cands = {f"{prefix}{random.randint(lo, hi)}" for _ in range(batch)} - found
+        taken = set(db.session.execute(
+            select(User.username).where(User.username.in_(cands))
+        ).scalars())
+        found.update(list(cands - taken)[:count - len(found)])
+        if len(found) == count:
+            return list(found)
+    raise click.ClickException(f"No se encontraron {count} usernames libres; usa más dígitos.")
 
 def _gen_username(prefix: str = "user", digits: int = 4) -> str:
     """Genera userNNNN con NNNN aleatorio, garantizando unicidad."""
-    while True:
-        uname = f"{prefix}{random.randint(10**(digits-1), 10**digits - 1)}"
-        if _find_user(uname) is None:
-            return uname
-
-def _apply_quota_defaults(u: User, app):
-    """Inicializa cuotas/contadores si están vacíos."""
-    if getattr(u, "xml_quota", None) is None:
-        u.xml_quota = int(app.config.get("TRIAL_XML_QUOTA", 40))
-    if getattr(u, "runs_quota", None) is None:
-        u.runs_quota = int(app.config.get("TRIAL_RUNS_QUOTA", 2))
-    if getattr(u, "xml_used", None) is None:
-        u.xml_used = 0
-    if getattr(u, "runs_used", None) is None:
-        u.runs_used = 0
+    return _gen_usernames(1, prefix=prefix, digits=digits)[0]
+
+
+def _users_listing(which: str = "all"):
+    """
+    SELECT de columnas sueltas (filas Core, sin armar objetos User) para los
+    listados. El uso sale de ServiceUsageLog agregado en la misma consulta:
+    xml_used = XML procesados, runs_used = ejecuciones.
+    """
+    usage = (
+        select(
+            ServiceUsageLog.user_id,
+            func.sum(ServiceUsageLog.xml_processed).label("xml_used"),
+            func.count(ServiceUsageLog.id).label("runs_used"),
+        )
+        .group_by(ServiceUsageLog.user_id)
+        .subquery()
+    )
+    stmt = (
+        select(
+            User.id, User.username, User.email, User.trial_ends_at, User.created_at,
+            func.coalesce(usage.c.xml_used, 0).label("xml_used"),
+            func.coalesce(usage.c.runs_used, 0).label("runs_used"),
+        )
+        .outerjoin(usage, usage.c.user_id == User.id)
+        .order_by(User.id.desc())
+    )
+    if which == "started":
+        stmt = stmt.where(User.trial_ends_at.isnot(None))
+    elif which == "no-usage":
+        stmt = stmt.where(usage.c.user_id.is_(None))
+    return stmt.execution_options(yield_per=200)
 
 
 # ───────────────────────── CLI ─────────────────────────
 def register_cli(app):
+    # Prefijo para volver absolutos los links relativos; la config ya está cargada
+    url_prefix = (
+        f"{app.config.get('PREFERRED_URL_SCHEME') or 'http'}://"
+        f"{app.config.get('SERVER_NAME') or '127.0.0.1:5000'}"
+    )
 
     @app.cli.command("init-db")
     def init_db_command():
@@ -105,18 +188,17 @@ def register_cli(app):
     @click.argument("ident")  # email o username existente/nuevo
     def trial_invite(ident):
         """Genera un Magic Link (invite_trial) para el ident dado."""
-        try:
-            link = create_magic_link(ident, "invite_trial")
-        except Exception as e:
-            raise click.ClickException(str(e))
+        # Repetir el comando enseguida (scripts, reintentos) no emite otro token
+        link = _recent_invite_link(ident)
+        if link is None:
+            try:
+                link, token = create_magic_link(ident, "invite_trial")
+            except Exception as e:
+                raise click.ClickException(str(e))
+            _remember_invite_link(token, link)
 
         # Normaliza URL absoluta si vino ruta relativa
-        if link.startswith("/"):
-            scheme = (app.config.get("PREFERRED_URL_SCHEME") or "http")
-            server = (app.config.get("SERVER_NAME") or "127.0.0.1:5000")
-            click.echo(f"{scheme}://{server}{link}")
-        else:
-            click.echo(link)
+        click.echo(f"{url_prefix}{link}" if link.startswith("/") else link)
 
     @app.cli.command("trial:new")
     @click.option("--prefix", default="user", help="Prefijo del username (por defecto: user)")
@@ -130,36 +212,55 @@ def register_cli(app):
         # ✅ NO crear el usuario aquí, dejar que create_magic_link lo haga
         # Generar magic link (que creará el usuario automáticamente)
         try:
-            link = create_magic_link(uname, "invite_trial")
+            link, _token = create_magic_link(uname, "invite_trial")
         except Exception as e:
             raise click.ClickException(str(e))
 
         if link.startswith("/"):
-            scheme = (app.config.get("PREFERRED_URL_SCHEME") or "http")
-            server = (app.config.get("SERVER_NAME") or "127.0.0.1:5000")
-            click.echo(f"username={uname}\n{scheme}://{server}{link}")
-        else:
-            click.echo(f"username={uname}\n{link}")
+            link = f"{url_prefix}{link}"
+        click.echo(f"username={uname}\n{link}")
 
 
             
 
+    @app.cli.command("trial:bulk-new")
+    @click.option("--count", type=int, required=True, help="Cantidad de usuarios trial a crear")
+    @click.option("--prefix", default="user", help="Prefijo del username (por defecto: user)")
+    @click.option("--digits", default=4, type=int, help="Cantidad de dígitos numéricos")
+    def trial_bulk_new(count, prefix, digits):
+        """
+        Crea COUNT usuarios trial NUEVOS en lote (un INSERT por tabla y un solo
+        commit) y lista sus Magic Links.
+        """
+        if count <= 0:
+            raise click.ClickException("--count debe ser mayor que 0.")
+        unames = _gen_usernames(count, prefix=prefix, digits=digits)
+        try:
+            links = create_trial_users_bulk(unames)
+        except Exception as e:
+            raise click.ClickException(str(e))
+        for uname, link in links:
+            click.echo(f"username={uname}\t{link}")
+
     @app.cli.command("trial:set")
     @click.argument("ident")
     @click.option("--seconds", type=int, default=None)
     @click.option("--minutes", type=int, default=None)
     @click.option("--hours", type=int, default=None)
     @click.option("--days", type=int, default=None)
-    @click.option("--xml", type=int, default=None, help="XML quota")
-    @click.option("--runs", type=int, default=None, help="Runs quota")
+    @click.option("--xml", type=int, default=None, help="(obsoleto: las cuotas se definen por plan)")
+    @click.option("--runs", type=int, default=None, help="(obsoleto: las cuotas se definen por plan)")
     def trial_set(ident, seconds, minutes, hours, days, xml, runs):
-        """Ajusta cuotas/tiempo para un usuario concreto (fija trial_ends_at desde ahora)."""
+        """Ajusta el tiempo de trial de un usuario (fija trial_ends_at desde ahora)."""
+        # Las cuotas ya no son del usuario: fallar en vez de responder OK sin cambiarlas
+        if xml is not None or runs is not None:
+            raise click.UsageError("las cuotas se definen por plan")
+
         u = _find_user(ident)
         if not u:
             raise click.ClickException("Usuario no encontrado")
 
-        if xml is not None:  u.xml_quota = xml
-        if runs is not None: u.runs_quota = runs
+        fields = {}
 
         if any(v is not None for v in (seconds, minutes, hours, days)):
             s = seconds or 0
@@ -169,9 +270,9 @@ def register_cli(app):
             delta = timedelta(seconds=s, minutes=m, hours=h, days=d)
             if delta.total_seconds() <= 0:
                 raise click.ClickException("Duración inválida (todo cero).")
-            u.trial_ends_at = _utcnow() + delta
+            fields["trial_ends_at"] = _utcnow() + delta
 
-        db.session.commit()
+        _update_user(u.id, **fields)
         click.echo("OK")
 
     @app.cli.command("trial:expire")
@@ -181,19 +282,25 @@ def register_cli(app):
         u = _find_user(ident)
         if not u:
             raise click.ClickException("Usuario no encontrado")
-        u.trial_ends_at = _utcnow() - timedelta(seconds=1)
-        db.session.commit()
+        _update_user(u.id, trial_ends_at=_utcnow() - timedelta(seconds=1))
         click.echo("Trial marcado como vencido")
 
     @app.cli.command("trial:reset-counters")
     @click.argument("ident")
     def trial_reset_counters(ident):
-        """Resetea xml_used/runs_used a 0."""
+        """Resetea a 0 el uso (xml/runs) de la suscripción activa."""
         u = _find_user(ident)
         if not u:
             raise click.ClickException("Usuario no encontrado")
-        u.xml_used = 0
-        u.runs_used = 0
+        # El uso vive en los contadores de la suscripción activa, no en User
+        active_sub = u.get_active_subscription()
+        if active_sub is None:
+            raise click.ClickException("El usuario no tiene suscripción activa")
+        db.session.execute(
+            update(UserPlanSubscriptionCounter)
+            .where(UserPlanSubscriptionCounter.sub_id == active_sub.id)
+            .values(xml_used=0, runs_used=0)
+        )
         db.session.commit()
         click.echo("Contadores reseteados")
 
@@ -205,10 +312,14 @@ def register_cli(app):
         if not u:
             raise click.ClickException("Usuario no encontrado")
         now = _utcnow()
+        quota = u.get_current_quota(DETRACCIONES_SERVICE_ID)
+        xml_quota = "ilimitado" if quota["is_unlimited"] else quota["quota"]
+        runs_quota = "ilimitado" if quota["runs_quota"] == -1 else quota["runs_quota"]
         click.echo(
             f"id={u.id}\n"
             f"username={u.username}\nemail={u.email}\n"
-            f"xml={u.xml_used}/{u.xml_quota}\nruns={u.runs_used}/{u.runs_quota}\n"
+            f"xml={quota['used']}/{xml_quota}\n"
+            f"runs={quota['runs_used']}/{runs_quota}\n"
             f"trial_ends_at={_fmt_lima(u.trial_ends_at)} (UTC: {u.trial_ends_at})\n"
             f"now={_fmt_lima(now)} (UTC: {now})"
         )
@@ -218,34 +329,25 @@ def register_cli(app):
     @app.cli.command("users:all")
     @click.option("--limit", default=100, type=int)
     def users_all(limit):
-        """Lista usuarios (id, user, email, trial_ends_at, xml/runs)."""
-        rows = db.session.execute(
-            select(User).order_by(User.id.desc()).limit(limit)
-        ).scalars().all()
-        for u in rows:
+        """Lista usuarios (id, user, email, trial_ends_at, xml/runs usados)."""
+        for r in db.session.execute(_users_listing().limit(limit)):
             click.echo(
-                f"id={u.id} user={u.username} email={u.email} "
-                f"trial_ends_at={_fmt_lima(u.trial_ends_at)} "
-                f"xml={u.xml_used}/{u.xml_quota} runs={u.runs_used}/{u.runs_quota}"
+                f"id={r.id} user={r.username} email={r.email} "
+                f"trial_ends_at={_fmt_lima(r.trial_ends_at)} "
+                f"xml={r.xml_used} runs={r.runs_used}"
             )
 
     @app.cli.command("users:started")
     def users_started():
         """Usuarios que YA iniciaron la prueba (trial_ends_at NO nulo)."""
-        rows = db.session.execute(
-            select(User).where(User.trial_ends_at.isnot(None)).order_by(User.id.desc())
-        ).scalars().all()
-        for u in rows:
-            click.echo(f"id={u.id} user={u.username} trial_ends_at={_fmt_lima(u.trial_ends_at)}")
+        for r in db.session.execute(_users_listing("started")):
+            click.echo(f"id={r.id} user={r.username} trial_ends_at={_fmt_lima(r.trial_ends_at)}")
 
     @app.cli.command("users:no-usage")
     def users_no_usage():
-        """Usuarios que no han procesado nada (xml_used=0 y runs_used=0)."""
-        rows = db.session.execute(
-            select(User).where(and_(User.xml_used == 0, User.runs_used == 0)).order_by(User.id.desc())
-        ).scalars().all()
-        for u in rows:
-            click.echo(f"id={u.id} user={u.username} xml={u.xml_used} runs={u.runs_used}")
+        """Usuarios que no han procesado nada (sin registros en ServiceUsageLog)."""
+        for r in db.session.execute(_users_listing("no-usage")):
+            click.echo(f"id={r.id} user={r.username} xml={r.xml_used} runs={r.runs_used}")
 
     @app.cli.command("users:export")
     @click.option("--which", type=click.Choice(["all", "started", "no-usage"]), default="all",
@@ -256,53 +358,59 @@ def register_cli(app):
                   help="'-' imprime en consola; si pasas ruta guarda a archivo")
     def users_export(which, limit, fmt, out):
         """Muestra/Exporta usuarios (tabla/csv/json)."""
-        q = select(User).order_by(User.id.desc())
-        if which == "started":
-            q = q.where(User.trial_ends_at.isnot(None))
-        elif which == "no-usage":
-            q = q.where(and_(User.xml_used == 0, User.runs_used == 0))
-        users = db.session.execute(q.limit(limit)).scalars().all()
-
-        rows = [{
-            "id": u.id,
-            "username": u.username or "",
-            "email": u.email or "",
-            "trial_ends_at": _fmt_lima(getattr(u, "trial_ends_at", None)),
-            "xml_used": getattr(u, "xml_used", 0),
-            "xml_quota": getattr(u, "xml_quota", 0),
-            "runs_used": getattr(u, "runs_used", 0),
-            "runs_quota": getattr(u, "runs_quota", 0),
-            "created_at": _fmt_lima(getattr(u, "created_at", None)),
-        } for u in users]
+        # yield_per: las filas llegan por tandas y cada una se escribe apenas
+        # se arma (csv/json), sin retener toda la lista en memoria
+        users = db.session.execute(_users_listing(which).limit(limit))
+
+        def _row(r):
+            return {
+                "id": r.id,
+                "username": r.username or "",
+                "email": r.email or "",
+                "trial_ends_at": _fmt_lima(r.trial_ends_at),
+                "xml_used": r.xml_used,
+                "runs_used": r.runs_used,
+                "created_at": _fmt_lima(r.created_at),
+            }
+
+        rows = (_row(r) for r in users)
 
         if fmt == "table":
+            # La tabla necesita todas las filas para calcular los anchos
+            rows = list(rows)
             if not rows:
                 click.echo("<< vacío >>")
                 return
             headers = list(rows[0].keys())
-            widths = {h: max(len(h), max(len(str(r[h])) for r in rows)) for h in headers}
-            sep = "+" + "+".join("-" * (widths[h] + 2) for h in headers) + "+"
-            click.echo(sep)
-            click.echo("|" + "|".join(f" {h.ljust(widths[h])} " for h in headers) + "|")
-            click.echo(sep)
-            for r in rows:
-                click.echo("|" + "|".join(f" {str(r[h]).ljust(widths[h])} " for h in headers) + "|")
-            click.echo(sep)
+            # Cada celda se convierte a str una sola vez; anchos en la misma pasada
+            srows = [[str(v) for v in r.values()] for r in rows]
+            widths = [max(len(h), *(len(sr[i]) for sr in srows)) for i, h in enumerate(headers)]
+            sep = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+            lines = [sep, "|" + "|".join(f" {h.ljust(w)} " for h, w in zip(headers, widths)) + "|", sep]
+            lines.extend("|" + "|".join(f" {s.ljust(w)} " for s, w in zip(sr, widths)) + "|" for sr in srows)
+            lines.append(sep)
+            click.echo("\n".join(lines))
             return
 
         stream = sys.stdout if out == "-" else open(out, "w", newline="", encoding="utf-8")
         try:
             if fmt == "csv":
-                fieldnames = list(rows[0].keys()) if rows else [
+                fieldnames = [
                     "id","username","email","trial_ends_at",
-                    "xml_used","xml_quota","runs_used","runs_quota","created_at"
+                    "xml_used","runs_used","created_at"
                 ]
                 writer = csv.DictWriter(stream, fieldnames=fieldnames)
                 writer.writeheader()
-                for r in rows:
-                    writer.writerow(r)
+                writer.writerows(rows)
             elif fmt == "json":
-                json.dump(rows, stream, ensure_ascii=False, indent=2)
+                # Mismo formato que json.dump(lista, indent=2), fila por fila
+                stream.write("[")
+                empty = True
+                for r in rows:
+                    item = json.dumps(r, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+                    stream.write(("\n  " if empty else ",\n  ") + item)
+                    empty = False
+                stream.write("]" if empty else "\n]")
         finally:
             if stream is not sys.stdout:
                 stream.close()
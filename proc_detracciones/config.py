@@ -16,6 +16,11 @@ class Config:
     
     # Limits
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
+
+    # Archivos desde disco (static/, comprobantes): si hay un Apache/lighttpd
+    # delante con X-Sendfile, que lo sirva él con sendfile(). Sin ese proxy
+    # debe quedar apagado; gunicorn ya usa wsgi.file_wrapper (sendfile) igual.
+    USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "0") == "1"
     
     # Email (SMTP) - Configuración desde variables de entorno
     MAIL_SERVER = os.getenv("MAIL_SERVER", "smtp.gmail.com")
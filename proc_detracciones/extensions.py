@@ -1,12 +1,45 @@
 # proc_detracciones/extensions.py
+from datetime import datetime, timezone
+
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
+from flask_compress import Compress
 
 db = SQLAlchemy()
 migrate = Migrate()
+compress = Compress()
 
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"          # adónde redirigir si no hay sesión
 login_manager.login_message = "Inicia sesión para continuar."
 login_manager.login_message_category = "warning"  # categoría de flash message (Bootstrap)
+
+
+def now_utc() -> datetime:
+    """
+    Instante UTC de la request actual: se calcula una vez y se guarda en `g`,
+    así el guard del trial y las consultas de suscripción comparan contra el
+    mismo "ahora". Fuera de una request (CLI) devuelve datetime.now().
+    """
+    if not has_request_context():
+        return datetime.now(timezone.utc)
+    now = g.get("_utc_now")
+    if now is None:
+        now = g._utc_now = datetime.now(timezone.utc)
+    return now
+
+
+def request_cache(name: str):
+    """
+    Dict guardado en `g` con el nombre dado, que vive lo que dura la request.
+    Fuera de una request (CLI) devuelve None: el llamador no cachea.
+    """
+    if not has_request_context():
+        return None
+    cache = g.get(name)
+    if cache is None:
+        cache = {}
+        setattr(g, name, cache)
+    return cache
@@ -1,17 +1,46 @@
 # proc_detracciones/models.py
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import enum
+from datetime import timezone
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import and_
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import deferred
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
-from .extensions import db
+from .extensions import db, now_utc, request_cache
 
+# Argon2id con el perfil mínimo de OWASP (19 MiB, t=2, p=1): mucho menos CPU por
+# login que el PBKDF2/scrypt de werkzeug con seguridad equivalente.
+_PH = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
 
-# ---------- helpers de tiempo (UTC aware) ----------
-def utcnow():
-    """Fecha/hora actual en UTC (timezone-aware)."""
-    return datetime.now(timezone.utc)
+
+# ---------- valores fijos de User ----------
+# str + Enum: los miembros se comparan igual que el texto ("admin",
+# "TRIAL_ACTIVO"), así rutas y plantillas siguen usando strings. En Postgres
+# se guardan como ENUM nativo (4 bytes) en vez de VARCHAR.
+class Role(str, enum.Enum):
+    user = "user"
+    admin = "admin"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class AccountStatus(str, enum.Enum):
+    TRIAL_ACTIVO = "TRIAL_ACTIVO"
+    TRIAL_VENCIDO = "TRIAL_VENCIDO"
+    PENDIENTE_VERIFICACION = "PENDIENTE_VERIFICACION"
+    PENDIENTE_PAGO = "PENDIENTE_PAGO"
+    PENDIENTE_REVISION = "PENDIENTE_REVISION"
+    ACTIVO = "ACTIVO"
+    SUSPENDIDO = "SUSPENDIDO"
+
+    def __str__(self) -> str:
+        return self.value
 
 
 # ---------- modelos ----------
@@ -29,18 +58,12 @@ class User(db.Model, UserMixin):
     password_hash = db.Column(db.String(255), nullable=True)
 
     # Estado/rol
-    role = db.Column(db.String(20), default="user", nullable=False)
+    role = db.Column(db.Enum(Role, name="role_enum"), default=Role.user, nullable=False)
     is_active_flag = db.Column(db.Boolean, default=True, nullable=False)
 
     # Trial (timezone-aware)
     trial_ends_at = db.Column(db.DateTime(timezone=True), nullable=True)
 
-    # Cuotas de trial
-    # xml_quota = db.Column(db.Integer, nullable=False, default=40)
-    # xml_used = db.Column(db.Integer, nullable=False, default=0)
-    # runs_quota = db.Column(db.Integer, nullable=False, default=2)
-    # runs_used = db.Column(db.Integer, nullable=False, default=0)
-
     # Verificación de email
     is_email_verified = db.Column(db.Boolean, default=False, nullable=False)
     email_verified_at = db.Column(db.DateTime(timezone=True), nullable=True)
@@ -52,17 +75,64 @@ class User(db.Model, UserMixin):
     phone = db.Column(db.String(15), nullable=True)  # ✅ NUEVO CAMPO
 
     # Gestión de cuenta
-    account_status = db.Column(db.String(24), default="TRIAL_ACTIVO", nullable=False)
+    account_status = db.Column(db.Enum(AccountStatus, name="account_status_enum"), default=AccountStatus.TRIAL_ACTIVO, nullable=False)
     payment_proof_submitted_at = db.Column(db.DateTime(timezone=True), nullable=True)
-    payment_proof_url = db.Column(db.Text, nullable=True)
+    # Columnas Text poco leídas: diferidas, se traen solo al accederlas (o con
+    # undefer_group en la vista que las muestra)
+    payment_proof_url = deferred(db.Column(db.Text, nullable=True), group='payment_proof')
     payment_reviewed_at = db.Column(db.DateTime(timezone=True), nullable=True)
-    payment_reviewed_by_admin_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
-
-    # Relación para el admin que revisó
-    reviewed_by_admin = db.relationship("User", remote_side=[id], backref="reviewed_users", uselist=False)
+    payment_reviewed_by_admin_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+
+    # Relación para el admin que revisó. Las relaciones a uno (aquí y en el
+    # resto de modelos) van con lazy="raise_on_sql": un acceso perezoso que
+    # iría a la BD (N+1 en listados) falla en vez de lanzar una consulta por
+    # fila; quien las use debe cargarlas con selectinload/joinedload.
+    reviewed_by_admin = db.relationship("User", remote_side=[id], back_populates="reviewed_users", uselist=False, lazy="raise_on_sql")
+
+    # Colecciones del usuario: lazy="write_only", nunca se materializan enteras
+    # (un usuario puede tener miles de logs). Se consultan con
+    # db.session.scalars(user.usage_logs.select().limit(...)). passive_deletes:
+    # al borrar el usuario no se cargan; las FKs (ON DELETE CASCADE / SET NULL)
+    # borran o desvinculan las filas en la misma sentencia DELETE.
+    reviewed_users = db.relationship("User", back_populates="reviewed_by_admin", lazy="write_only", passive_deletes=True)
+    auth_tokens = db.relationship("AuthToken", back_populates="user", lazy="write_only", passive_deletes=True)
+    plan_subscriptions = db.relationship(
+        "UserPlanSubscription", foreign_keys="UserPlanSubscription.user_id",
+        back_populates="user", lazy="write_only", passive_deletes=True,
+    )
+    usage_logs = db.relationship("ServiceUsageLog", back_populates="user", lazy="write_only", passive_deletes=True)
 
     # Auditoría
-    created_at = db.Column(db.DateTime(timezone=True), default=utcnow, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), nullable=False)
+
+    # Listado de admin: filtra por estado y ordena por fecha de alta (paginado).
+    # ix_user_admin: índice parcial con solo los admins (guardas de "último admin").
+    # ix_user_search_trgm (solo Postgres, pg_trgm): GIN de trigramas sobre
+    # search_text, para que el ILIKE '%...%' del buscador no recorra la tabla.
+    __table_args__ = (
+        db.Index('ix_user_status_created', 'account_status', 'created_at'),
+        db.Index('ix_user_admin', 'id',
+                 postgresql_where=db.text("role = 'admin'"), sqlite_where=db.text("role = 'admin'")),
+        db.Index('ix_user_search_trgm', db.text(
+            "(coalesce(email, '') || ' ' || coalesce(username, '') || ' ' || "
+            "coalesce(first_name, '') || ' ' || coalesce(last_name, '')) gin_trgm_ops"
+        ), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
+    @hybrid_property
+    def search_text(self) -> str:
+        """Email, username, nombre y apellido en un solo texto (buscador de admin)."""
+        return " ".join(v or "" for v in (self.email, self.username, self.first_name, self.last_name))
+
+    @search_text.expression
+    def search_text(cls):
+        # Misma expresión que ix_user_search_trgm, con literales en línea (no
+        # parámetros) para que el planner de Postgres la reconozca
+        sep, empty = db.literal_column("' '"), db.literal_column("''")
+        email, username, first_name, last_name = (
+            db.func.coalesce(col, empty) for col in (cls.email, cls.username, cls.first_name, cls.last_name)
+        )
+        return email + sep + username + sep + first_name + sep + last_name
 
 
     # Agregar estos campos a la clase User para la suscripción
@@ -77,23 +147,68 @@ class User(db.Model, UserMixin):
 
     def get_active_subscription(self):
         """Devuelve la suscripción activa actual del usuario, o None si no tiene."""
-        from datetime import datetime, timezone
-        
-        return UserPlanSubscription.query.filter(
-            UserPlanSubscription.user_id == self.id,
-            UserPlanSubscription.is_active == True,
-            UserPlanSubscription.ends_at > datetime.now(timezone.utc)
-        ).order_by(UserPlanSubscription.ends_at.desc()).first()
+        from sqlalchemy import lambda_stmt, select
+        from sqlalchemy.orm import joinedload
+
+        # Nav, guard y vista la piden varias veces por request: una sola consulta
+        cache = request_cache("_sub_cache")
+        if cache is not None and self.id in cache:
+            return cache[self.id]
+
+        # El plan viene en la misma consulta: las vistas muestran sub.plan.name.
+        # lambda_stmt cachea el SQL compilado; uid y now entran como parámetros
+        # (es el predicado de currently_active con "ahora" fijado fuera del lambda).
+        uid, now = self.id, now_utc()
+        stmt = lambda_stmt(
+            lambda: select(UserPlanSubscription)
+            .options(joinedload(UserPlanSubscription.plan))
+            .where(
+                UserPlanSubscription.user_id == uid,
+                UserPlanSubscription.is_active == True,
+                UserPlanSubscription.ends_at > now,
+            )
+            .order_by(UserPlanSubscription.ends_at.desc())
+            .limit(1)
+        )
+        sub = db.session.execute(stmt).scalar_one_or_none()
+        if cache is not None:
+            cache[self.id] = sub
+        return sub
+
+    def clear_plan_cache(self) -> None:
+        """Olvida la suscripción y cuotas cacheadas en la request (tras escribirlas)."""
+        sub_cache = request_cache("_sub_cache")
+        if sub_cache is not None:
+            sub_cache.pop(self.id, None)
+        quota_cache = request_cache("_quota_cache")
+        if quota_cache is not None:
+            for key in [k for k in quota_cache if k[0] == self.id]:
+                del quota_cache[key]
 
 
     # ---- helpers ----
     def set_password(self, pw: str) -> None:
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = _PH.hash(pw)
 
     def check_password(self, pw: str) -> bool:
+        """
+        Verifica la contraseña. Si el hash es legado (werkzeug: pbkdf2/scrypt)
+        o usa parámetros viejos, lo rehace con Argon2; el llamador hace commit.
+        """
         if not self.password_hash:
             return False
-        return check_password_hash(self.password_hash, pw)
+        if not self.password_hash.startswith("$argon2"):
+            if not check_password_hash(self.password_hash, pw):
+                return False
+            self.set_password(pw)
+            return True
+        try:
+            _PH.verify(self.password_hash, pw)
+        except (VerificationError, InvalidHashError):
+            return False
+        if _PH.check_needs_rehash(self.password_hash):
+            self.set_password(pw)
+        return True
 
     @property
     def is_active(self) -> bool:
@@ -106,54 +221,81 @@ class User(db.Model, UserMixin):
 
     def get_current_quota(self, service_id: int):
         """Calcula la cuota total y usada de un usuario para un servicio específico."""
-        from .models import UserPlanSubscription, PlanServiceQuota, ServiceUsageLog
-        from sqlalchemy import func
-        from datetime import datetime, timezone
-
-        # 1. Buscar LA ÚLTIMA suscripción activa (la más reciente)
-        active_sub = db.session.query(UserPlanSubscription).filter(
-            UserPlanSubscription.user_id == self.id,
-            UserPlanSubscription.is_active == True,
-            UserPlanSubscription.ends_at > datetime.now(timezone.utc)
-        ).order_by(UserPlanSubscription.created_at.desc()).first()
-
-        if not active_sub:
-            return {
-                "quota": 0,
-                "used": 0,
-                "remaining": 0,
-                "is_unlimited": False
-            }
-
-        # 2. Obtener la cuota del plan
-        plan_quota = db.session.query(PlanServiceQuota).filter_by(
-            plan_id=active_sub.plan_id, service_id=service_id
+        from .models import UserPlanSubscription, PlanServiceQuota, UserPlanSubscriptionCounter
+        from sqlalchemy import and_, func, select
+
+        cache = request_cache("_quota_cache")
+        if cache is not None and (self.id, service_id) in cache:
+            return cache[(self.id, service_id)]
+
+        # 1. LA ÚLTIMA suscripción activa (la más reciente) junto con la cuota
+        #    de su plan y el uso acumulado en el período (XML y ejecuciones), en
+        #    una sola consulta (sin fila de contador todavía: COALESCE da 0)
+        row = db.session.execute(
+            select(
+                PlanServiceQuota.xml_quota,
+                PlanServiceQuota.runs_quota,
+                func.coalesce(UserPlanSubscriptionCounter.xml_used, 0).label("xml_used"),
+                func.coalesce(UserPlanSubscriptionCounter.runs_used, 0).label("runs_used"),
+            )
+            .select_from(UserPlanSubscription)
+            .outerjoin(PlanServiceQuota, and_(
+                PlanServiceQuota.plan_id == UserPlanSubscription.plan_id,
+                PlanServiceQuota.service_id == service_id,
+            ))
+            .outerjoin(UserPlanSubscriptionCounter, and_(
+                UserPlanSubscriptionCounter.sub_id == UserPlanSubscription.id,
+                UserPlanSubscriptionCounter.service_id == service_id,
+            ))
+            .where(
+                UserPlanSubscription.user_id == self.id,
+                UserPlanSubscription.currently_active,
+            )
+            .order_by(UserPlanSubscription.created_at.desc())
+            .limit(1)
         ).first()
 
-        if not plan_quota:
-            return {
+        # 2. Sin suscripción activa o sin cuota del plan para el servicio
+        if row is None or row.xml_quota is None:
+            info = {
                 "quota": 0,
                 "used": 0,
                 "remaining": 0,
-                "is_unlimited": False
+                "is_unlimited": False,
+                "runs_quota": None,
+                "runs_used": 0,
             }
+            if cache is not None:
+                cache[(self.id, service_id)] = info
+            return info
+        xml_quota = row.xml_quota
 
-        is_unlimited = (plan_quota.xml_quota == -1)
-        total_quota = plan_quota.xml_quota if not is_unlimited else 0
+        is_unlimited = (xml_quota == -1)
+        total_quota = xml_quota if not is_unlimited else 0
 
-        # 3. Buscar el uso SOLO desde que inició la suscripción actual
-        usage = db.session.query(func.sum(ServiceUsageLog.xml_processed)).filter(
-            ServiceUsageLog.user_id == self.id,
-            ServiceUsageLog.service_id == service_id,
-            ServiceUsageLog.completed_at >= active_sub.starts_at  # ✅ FILTRO NUEVO
-        ).scalar() or 0
+        # 3. Uso SOLO desde que inició la suscripción actual: lo lleva el
+        #    contador (record_service_usage), sin sumar los logs
+        usage = row.xml_used
 
-        return {
+        info = {
             "quota": total_quota,
             "used": usage,
             "remaining": (total_quota - usage) if not is_unlimited else float('inf'),
-            "is_unlimited": is_unlimited
-        }    # <-- FIN DE LA FUNCIÓN 
+            "is_unlimited": is_unlimited,
+            # Ejecuciones del período (-1 = sin límite), del mismo contador
+            "runs_quota": row.runs_quota,
+            "runs_used": row.runs_used,
+        }
+        if cache is not None:
+            cache[(self.id, service_id)] = info
+        return info    # <-- FIN DE LA FUNCIÓN 
+
+
+# ix_user_search_trgm necesita la extensión pg_trgm (db.create_all en Postgres)
+db.event.listen(
+    User.__table__, "before_create",
+    db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
 
 
 class AuthToken(db.Model):
@@ -166,21 +308,21 @@ class AuthToken(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
-    user = db.relationship("User", backref="auth_tokens")
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"), nullable=True)
+    user = db.relationship("User", back_populates="auth_tokens", lazy="raise_on_sql")
 
     # "magic_login", "invite_trial", "verify_email"
     purpose = db.Column(db.String(20), nullable=False)
 
-    # Para magic links: guardamos el hash del token
-    token_hash = db.Column(db.String(128), unique=True, nullable=False, index=True)
+    # Para magic links: guardamos el SHA-256 del token (32 bytes crudos, no hex)
+    token_hash = db.Column(db.LargeBinary(32), unique=True, nullable=False, index=True)
 
     # NUEVO: Para verificación por código de 4 dígitos
-    code = db.Column(db.String(4), nullable=True, index=True)
+    code = db.Column(db.String(4), nullable=True)
 
     # Fechas timezone-aware
     expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
-    created_at = db.Column(db.DateTime(timezone=True), default=utcnow, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), nullable=False)
     first_used_at = db.Column(db.DateTime(timezone=True), nullable=True)
 
     # Control de uso
@@ -193,7 +335,15 @@ class AuthToken(db.Model):
     reference_note = db.Column(db.String(255), nullable=True)
     first_used_ip = db.Column(db.String(45), nullable=True)
 
-    magic_link_url = db.Column(db.Text, nullable=True)  # ✅ NUEVO CAMPO
+    magic_link_url = deferred(db.Column(db.Text, nullable=True), group='magic_link')  # ✅ NUEVO CAMPO
+
+    # verify-code y reset-password buscan por (user_id, purpose, code) entre
+    # los no revocados: un solo seek en un índice que ignora los revocados.
+    # token_hash ya tiene su índice único (el magic link busca solo por él).
+    __table_args__ = (
+        db.Index('ix_auth_token_code_active', 'user_id', 'purpose', 'code',
+                 postgresql_where=db.text('revoked = false'), sqlite_where=db.text('revoked = 0')),
+    )
 
     def __repr__(self) -> str:
         return f"<AuthToken user_id={self.user_id} purpose={self.purpose} used={self.used_count}/{self.max_uses}>"
@@ -214,10 +364,11 @@ class Plan(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     is_unlimited = db.Column(db.Boolean, default=False)  # Si es True, ignora quotas
     trial_days = db.Column(db.Integer, nullable=True) 
-    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     
     # Relaciones
-    service_quotas = db.relationship('PlanServiceQuota', backref='plan', cascade='all, delete-orphan')
+    service_quotas = db.relationship('PlanServiceQuota', back_populates='plan', cascade='all, delete-orphan', lazy='raise_on_sql')
+    subscriptions = db.relationship('UserPlanSubscription', back_populates='plan', lazy='raise_on_sql')
 
 
 class Service(db.Model):
@@ -229,10 +380,11 @@ class Service(db.Model):
     slug = db.Column(db.String(100), unique=True, nullable=False)  # "detracciones"
     description = db.Column(db.Text)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     
     # Relaciones
-    quotas = db.relationship('PlanServiceQuota', backref='service', cascade='all, delete-orphan')
+    quotas = db.relationship('PlanServiceQuota', back_populates='service', cascade='all, delete-orphan', lazy='raise_on_sql')
+    usage_logs = db.relationship('ServiceUsageLog', back_populates='service', lazy='raise_on_sql')
 
 
 class PlanServiceQuota(db.Model):
@@ -246,6 +398,10 @@ class PlanServiceQuota(db.Model):
     # Cuotas (-1 = ilimitado)
     xml_quota = db.Column(db.Integer, default=-1)  # -1 = sin límite
     runs_quota = db.Column(db.Integer, default=-1)
+
+    # Relaciones
+    plan = db.relationship('Plan', back_populates='service_quotas', lazy='raise_on_sql')
+    service = db.relationship('Service', back_populates='quotas', lazy='raise_on_sql')
     
     __table_args__ = (db.UniqueConstraint('plan_id', 'service_id', name='unique_plan_service'),)
 
@@ -255,7 +411,7 @@ class UserPlanSubscription(db.Model):
     __tablename__ = 'user_plan_subscription'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'), nullable=False)
     
     # Vigencia
@@ -265,15 +421,93 @@ class UserPlanSubscription(db.Model):
     # Estado
     is_active = db.Column(db.Boolean, default=True)
     auto_renew = db.Column(db.Boolean, default=False)
+
+    @hybrid_property
+    def currently_active(self) -> bool:
+        """Activa y sin vencer (mismo "ahora" de la request que el guard del trial)."""
+        ends = self.ends_at
+        if ends is not None and ends.tzinfo is None:
+            ends = ends.replace(tzinfo=timezone.utc)
+        return bool(self.is_active) and ends is not None and ends > now_utc()
+
+    @currently_active.expression
+    def currently_active(cls):
+        # "is_active = true" tal cual: coincide con el WHERE de los índices parciales
+        return and_(cls.is_active == True, cls.ends_at > now_utc())
     
     # Auditoría
-    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
-    created_by_admin_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    created_by_admin_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
     
     # Relaciones
-    user = db.relationship('User', foreign_keys=[user_id], backref='plan_subscriptions')
-    plan = db.relationship('Plan', backref='subscriptions')
-    created_by = db.relationship('User', foreign_keys=[created_by_admin_id])
+    user = db.relationship('User', foreign_keys=[user_id], back_populates='plan_subscriptions', lazy='raise_on_sql')
+    plan = db.relationship('Plan', back_populates='subscriptions', lazy='raise_on_sql')
+    created_by = db.relationship('User', foreign_keys=[created_by_admin_id], lazy='raise_on_sql')
+
+    # Índices parciales solo sobre suscripciones activas (las únicas que se
+    # consultan por usuario): get_active_subscription ordena por ends_at,
+    # get_current_quota y record_service_usage por created_at.
+    __table_args__ = (
+        db.Index('ix_ups_user_active_endsat', 'user_id', 'ends_at',
+                 postgresql_where=db.text('is_active = true'), sqlite_where=db.text('is_active = 1')),
+        db.Index('ix_ups_user_active_created', 'user_id', 'created_at',
+                 postgresql_where=db.text('is_active = true'), sqlite_where=db.text('is_active = 1')),
+    )
+
+
+class UserPlanSubscriptionCounter(db.Model):
+    """Uso acumulado de una suscripción por servicio (evita el SUM sobre los logs)"""
+    __tablename__ = 'user_plan_subscription_counter'
+
+    sub_id = db.Column(db.Integer, db.ForeignKey('user_plan_subscription.id', ondelete='CASCADE'), primary_key=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('service.id'), primary_key=True)
+
+    xml_used = db.Column(db.Integer, default=0, nullable=False)
+    runs_used = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+
+def record_service_usage(user_id: int, service_id: int, xml_processed: int) -> None:
+    """
+    Suma una ejecución y sus XML al contador de la suscripción vigente (la
+    misma que usa get_current_quota). Va en la transacción del ServiceUsageLog:
+    el llamador hace commit.
+    """
+    from sqlalchemy import select, update
+    from sqlalchemy.exc import IntegrityError
+
+    sub_id = db.session.execute(
+        select(UserPlanSubscription.id)
+        .where(
+            UserPlanSubscription.user_id == user_id,
+            UserPlanSubscription.currently_active,
+        )
+        .order_by(UserPlanSubscription.created_at.desc())
+        .limit(1)
+    ).scalar_one_or_none()
+    if sub_id is None:
+        return
+
+    bump = (
+        update(UserPlanSubscriptionCounter)
+        .where(UserPlanSubscriptionCounter.sub_id == sub_id,
+               UserPlanSubscriptionCounter.service_id == service_id)
+        .values(xml_used=UserPlanSubscriptionCounter.xml_used + xml_processed,
+                runs_used=UserPlanSubscriptionCounter.runs_used + 1,
+                updated_at=db.func.now())
+    )
+    if db.session.execute(bump).rowcount:
+        return
+    # Primera ejecución del período: crear la fila (si otra request la creó
+    # en paralelo, el INSERT choca con la PK y se vuelve al UPDATE)
+    try:
+        with db.session.begin_nested():
+            db.session.add(UserPlanSubscriptionCounter(
+                sub_id=sub_id, service_id=service_id,
+                xml_used=xml_processed, runs_used=1,
+            ))
+    except IntegrityError:
+        db.session.execute(bump)
 
 
 class ServiceUsageLog(db.Model):
@@ -281,7 +515,7 @@ class ServiceUsageLog(db.Model):
     __tablename__ = 'service_usage_log'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     service_id = db.Column(db.Integer, db.ForeignKey('service.id'), nullable=False)
     
     # Detalles del procesamiento
@@ -293,16 +527,22 @@ class ServiceUsageLog(db.Model):
     lote_number = db.Column(db.String(10))  # Número de lote procesado
     processing_time_seconds = db.Column(db.Float)  # Tiempo de ejecución
     ip_address = db.Column(db.String(45))
-    user_agent = db.Column(db.Text)
+    user_agent = deferred(db.Column(db.Text), group='audit')
     
     # Timestamps
-    started_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    started_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     completed_at = db.Column(db.DateTime(timezone=True))
     
     # Relaciones
-    user = db.relationship('User', backref='usage_logs')
-    service = db.relationship('Service', backref='usage_logs')
-    error_log = db.relationship('ServiceErrorLog', uselist=False, backref='usage_log')
+    user = db.relationship('User', back_populates='usage_logs', lazy='raise_on_sql')
+    service = db.relationship('Service', back_populates='usage_logs', lazy='raise_on_sql')
+    error_log = db.relationship('ServiceErrorLog', uselist=False, back_populates='usage_log', lazy='raise_on_sql', passive_deletes=True)
+
+    # user_id al frente: borrado en cascada y agrupados por usuario; el uso
+    # del período ya no se suma de acá (lo lleva UserPlanSubscriptionCounter)
+    __table_args__ = (
+        db.Index('ix_usage_user_svc_completed', 'user_id', 'service_id', 'completed_at'),
+    )
 
 
 class ServiceErrorLog(db.Model):
@@ -310,14 +550,17 @@ class ServiceErrorLog(db.Model):
     __tablename__ = 'service_error_log'
     
     id = db.Column(db.Integer, primary_key=True)
-    usage_log_id = db.Column(db.Integer, db.ForeignKey('service_usage_log.id'), nullable=False)
+    usage_log_id = db.Column(db.Integer, db.ForeignKey('service_usage_log.id', ondelete='CASCADE'), nullable=False)
     
     # Error
     error_type = db.Column(db.String(100))  # "ValidationError", "ZipError", etc.
-    error_message = db.Column(db.Text)
-    stack_trace = db.Column(db.Text)
+    error_message = deferred(db.Column(db.Text), group='error_detail')
+    stack_trace = deferred(db.Column(db.Text), group='error_detail')
     
     # Timestamp
-    occurred_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    occurred_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    # Relaciones
+    usage_log = db.relationship('ServiceUsageLog', back_populates='error_log', lazy='raise_on_sql')
 
 
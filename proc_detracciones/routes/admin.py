@@ -1,32 +1,166 @@
 # proc_detracciones/routes/admin.py
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, jsonify
-from flask_login import login_required, current_user
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
+from flask_login import current_user
 from functools import wraps
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import or_
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload, raiseload, selectinload, undefer_group
 import io
 import csv
+import time
 
-from proc_detracciones.extensions import db
-from proc_detracciones.models import User
+from proc_detracciones.extensions import db, request_cache
+from proc_detracciones.models import User, AccountStatus
 
 admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
 
+_USERS_PER_PAGE = 25
+_EXPORT_CHUNK = 500
+_PLANS_TTL = 60  # segundos
+
+# Los listados cargan explícitamente (selectinload/joinedload) lo que la
+# plantilla usa y cierran el resto con raiseload('*'): si una plantilla nueva
+# toca otra relación falla al instante en vez de hacer una consulta por fila.
+
 def admin_required(f):
+    """login_required + rol admin en un solo wrapper.
+
+    Resuelve current_user una vez; sin sesión redirige al login igual que
+    login_required.
+    """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.role != 'admin':
+        user = current_user._get_current_object()
+        if not user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        if user.role != 'admin':
             flash('Acceso denegado', 'danger')
             return redirect(url_for('home.index'))
         return f(*args, **kwargs)
     return decorated_function
 
+def _active_subs_by_user(user_ids):
+    """Suscripción activa (con su plan) de varios usuarios en una sola consulta.
+
+    Mismo criterio que User.get_active_subscription: la que vence más tarde.
+    """
+    from proc_detracciones.models import UserPlanSubscription
+
+    subs = db.session.scalars(
+        select(UserPlanSubscription)
+        .options(joinedload(UserPlanSubscription.plan), raiseload('*'))
+        .where(
+            UserPlanSubscription.user_id.in_(user_ids),
+            UserPlanSubscription.currently_active,
+        )
+        .order_by(UserPlanSubscription.ends_at.desc())
+    )
+    active = {}
+    for sub in subs:
+        active.setdefault(sub.user_id, sub)
+    return active
+
+def _apply_plan_status(user, plan):
+    """Estado de la cuenta según el tipo de plan asignado."""
+    if plan.slug and 'trial' in plan.slug.lower():
+        user.account_status = 'TRIAL_ACTIVO'
+    else:
+        user.account_status = 'ACTIVO'
+
+def _replace_subscription(user, plan, starts_at, ends_at):
+    """Desactiva las suscripciones activas del usuario y le crea una nueva.
+
+    Todo queda en la transacción en curso (sin flush intermedio): el UPDATE
+    sale al momento y el INSERT en el commit del llamador. También ajusta
+    account_status al plan.
+    """
+    from proc_detracciones.models import UserPlanSubscription
+
+    UserPlanSubscription.query.filter_by(user_id=user.id, is_active=True).update(
+        {'is_active': False}, synchronize_session=False
+    )
+    subscription = UserPlanSubscription(
+        user_id=user.id,
+        plan_id=plan.id,
+        starts_at=starts_at,
+        ends_at=ends_at,
+        is_active=True,
+        auto_renew=False
+    )
+    db.session.add(subscription)
+    _apply_plan_status(user, plan)
+    return subscription
+
+def _delete_user_dependents(user_id):
+    """Lo que ON DELETE CASCADE / SET NULL hace en Postgres, para SQLite."""
+    from proc_detracciones.models import (
+        AuthToken, ServiceErrorLog, ServiceUsageLog, UserPlanSubscription, UserPlanSubscriptionCounter,
+    )
+
+    sub_ids = db.session.query(UserPlanSubscription.id).filter_by(user_id=user_id)
+    UserPlanSubscriptionCounter.query.filter(
+        UserPlanSubscriptionCounter.sub_id.in_(sub_ids.scalar_subquery())
+    ).delete(synchronize_session=False)
+    UserPlanSubscription.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+    log_ids = db.session.query(ServiceUsageLog.id).filter_by(user_id=user_id)
+    ServiceErrorLog.query.filter(
+        ServiceErrorLog.usage_log_id.in_(log_ids.scalar_subquery())
+    ).delete(synchronize_session=False)
+    ServiceUsageLog.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+    AuthToken.query.filter_by(user_id=user_id).update({'user_id': None}, synchronize_session=False)
+    User.query.filter_by(payment_reviewed_by_admin_id=user_id).update(
+        {'payment_reviewed_by_admin_id': None}, synchronize_session=False
+    )
+    UserPlanSubscription.query.filter_by(created_by_admin_id=user_id).update(
+        {'created_by_admin_id': None}, synchronize_session=False
+    )
+
+def _active_plans():
+    """Planes activos (id, name, price_monthly) para los selects de users_list.
+
+    Cambian poco: se guardan en el proceso _PLANS_TTL segundos como filas
+    simples (no instancias ORM, que no se pueden compartir entre requests).
+    Crear/editar/borrar un plan lo invalida en este worker.
+    """
+    from proc_detracciones.models import Plan
+
+    cache = current_app.extensions.setdefault('admin_active_plans', {})
+    cached = cache.get('plans')
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    plans = db.session.execute(
+        select(Plan.id, Plan.name, Plan.price_monthly).where(Plan.is_active == True).order_by(Plan.id)
+    ).all()
+    cache['plans'] = (time.monotonic() + _PLANS_TTL, plans)
+    return plans
+
+def _forget_active_plans():
+    current_app.extensions.get('admin_active_plans', {}).pop('plans', None)
+
+def _quota_rows(plan_id, selected_services):
+    """Filas de PlanServiceQuota del formulario de plan (cuotas por servicio)."""
+    rows = []
+    for service_id in selected_services:
+        service_id = int(service_id)
+        rows.append({
+            'plan_id': plan_id,
+            'service_id': service_id,
+            'xml_quota': int(request.form.get(f'xml_quota_{service_id}', '-1')),
+            'runs_quota': int(request.form.get(f'runs_quota_{service_id}', '-1')),
+        })
+    return rows
+
+def _has_other_admin(exclude_id):
+    """¿Queda algún admin además de exclude_id? Basta encontrar uno (LIMIT 1)."""
+    return db.session.query(User.id).filter(
+        User.role == 'admin', User.id != exclude_id
+    ).limit(1).first() is not None
+
 @admin_bp.route('/users')
-@login_required
 @admin_required
 def users_list():
-    from proc_detracciones.models import Plan # <-- IMPORTACIÓN LOCAL PARA MÁS EFICIENCIA
-    
     status_filter = request.args.get('status', 'all')
     search_query = request.args.get('search', '').strip()
     
@@ -36,46 +170,53 @@ def users_list():
     if status_filter != 'all':
         if status_filter == 'PENDIENTE_APROBACION':
             # Incluir tanto PENDIENTE_REVISION como PENDIENTE_PAGO
-            from sqlalchemy import or_
             query = query.filter(or_(User.account_status == 'PENDIENTE_REVISION', 
                                      User.account_status == 'PENDIENTE_PAGO'))
-        else:
+        elif status_filter in AccountStatus.__members__:
+            # Solo valores del enum: en Postgres un literal desconocido falla
             query = query.filter_by(account_status=status_filter)
 
 
-    # Búsqueda por email, username, nombre o apellido
+    # Búsqueda por email, username, nombre o apellido (un solo ILIKE sobre
+    # User.search_text: en Postgres lo resuelve el índice de trigramas)
     if search_query:
         search_pattern = f"%{search_query}%"
-        query = query.filter(
-            or_(
-                User.email.ilike(search_pattern),
-                User.username.ilike(search_pattern),
-                User.first_name.ilike(search_pattern),
-                User.last_name.ilike(search_pattern)
-            )
-        )
-    
-    users = query.order_by(User.created_at.desc()).all()
+        query = query.filter(User.search_text.ilike(search_pattern))
     
-    # Estadísticas
-    pending_verification = User.query.filter_by(account_status='PENDIENTE_VERIFICACION').count()
-    from sqlalchemy import or_
-
-    pending_review = User.query.filter(
-        or_(
-            User.account_status == 'PENDIENTE_REVISION',
-            User.account_status == 'PENDIENTE_PAGO'
-        )
-    ).count()
-    trial_active = User.query.filter_by(account_status='TRIAL_ACTIVO').count()
-    active = User.query.filter_by(account_status='ACTIVO').count()
-    suspended = User.query.filter_by(account_status='SUSPENDIDO').count()
+    # La tabla enlaza el comprobante de pago de cada usuario. Paginado en el
+    # servidor: nunca se cargan/renderizan más de _USERS_PER_PAGE filas
+    page = request.args.get('page', 1, type=int)
+    pagination = query.options(undefer_group('payment_proof'), raiseload('*')).order_by(User.created_at.desc()).paginate(
+        page=page, per_page=_USERS_PER_PAGE, error_out=False
+    )
+    users = pagination.items
+
+    # La plantilla llama user.get_active_subscription() por fila: se traen
+    # todas las de la página en una consulta y quedan en la caché de la request
+    sub_cache = request_cache("_sub_cache")
+    if sub_cache is not None:
+        active_subs = _active_subs_by_user([user.id for user in users])
+        for user in users:
+            sub_cache[user.id] = active_subs.get(user.id)
+    
+    # Estadísticas: un solo GROUP BY (lo resuelve ix_user_status_created)
+    counts = dict(
+        db.session.query(User.account_status, db.func.count(User.id))
+        .group_by(User.account_status)
+        .all()
+    )
+    pending_verification = counts.get(AccountStatus.PENDIENTE_VERIFICACION, 0)
+    pending_review = counts.get(AccountStatus.PENDIENTE_REVISION, 0) + counts.get(AccountStatus.PENDIENTE_PAGO, 0)
+    trial_active = counts.get(AccountStatus.TRIAL_ACTIVO, 0)
+    active = counts.get(AccountStatus.ACTIVO, 0)
+    suspended = counts.get(AccountStatus.SUSPENDIDO, 0)
     
     # Obtener los planes activos para el modal
-    plans = Plan.query.filter_by(is_active=True).all()
+    plans = _active_plans()
     
     return render_template('admin/users.html',
                       users=users,
+                      pagination=pagination,
                       pending_verification=pending_verification,
                       pending_review=pending_review,
                       trial_active=trial_active,
@@ -88,12 +229,11 @@ def users_list():
 
 
 @admin_bp.route('/user/<int:user_id>/approve', methods=['POST'])
-@login_required
 @admin_required
 def approve_user(user_id):
-    from proc_detracciones.models import UserPlanSubscription, Plan
+    from proc_detracciones.models import Plan
     
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     months = int(request.form.get('months', 1))
     plan_id = int(request.form.get('plan_id'))
     
@@ -101,32 +241,13 @@ def approve_user(user_id):
         flash('Debes ingresar al menos 1 mes', 'warning')
         return redirect(url_for('admin.users_list'))
         
-    plan = Plan.query.get_or_404(plan_id)
+    plan = db.get_or_404(Plan, plan_id)
     now = datetime.now(timezone.utc)
     days = months * 30
     
-    # ✅ DESACTIVAR SUSCRIPCIONES ANTERIORES
-    UserPlanSubscription.query.filter_by(user_id=user.id, is_active=True).update({'is_active': False})
-    db.session.flush()
-    
-    # Crear la nueva suscripción
-    subscription = UserPlanSubscription(
-        user_id=user.id,
-        plan_id=plan_id,
-        starts_at=now,
-        ends_at=now + timedelta(days=days),
-        is_active=True,
-        auto_renew=False
-    )
-    db.session.add(subscription)
-    
-    # ✅ ACTUALIZAR ESTADO SEGÚN EL TIPO DE PLAN
-    if plan.slug and 'trial' in plan.slug.lower():
-        user.account_status = 'TRIAL_ACTIVO'
-    else:
-        user.account_status = 'ACTIVO'
-    
+    subscription = _replace_subscription(user, plan, now, now + timedelta(days=days))
     db.session.commit()
+    user.clear_plan_cache()
     
     end_date = subscription.ends_at.strftime('%d/%m/%Y %H:%M')
     flash(f'Usuario {user.email} activado con el plan "{plan.name}" por {months} mes(es). Vence: {end_date}', 'success')
@@ -136,20 +257,18 @@ def approve_user(user_id):
 
 
 @admin_bp.route('/user/<int:user_id>/suspend', methods=['POST'])
-@login_required
 @admin_required
 def suspend_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     user.account_status = 'SUSPENDIDO'
     db.session.commit()
     flash(f'Usuario {user.email} suspendido', 'warning')
     return redirect(url_for('admin.users_list'))
 
 @admin_bp.route('/user/<int:user_id>/reactivate', methods=['POST'])
-@login_required
 @admin_required
 def reactivate_user(user_id):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
     # Verificar si tiene una suscripción activa válida
     active_sub = user.get_active_subscription()
@@ -164,10 +283,9 @@ def reactivate_user(user_id):
     return redirect(url_for('admin.users_list'))
 
 @admin_bp.route('/user/<int:user_id>/set-pending', methods=['POST'])
-@login_required
 @admin_required
 def set_pending(user_id):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     user.account_status = 'PENDIENTE_REVISION'
     db.session.commit()
     flash(f'Usuario {user.email} marcado como pendiente de revisión', 'info')
@@ -177,12 +295,11 @@ def set_pending(user_id):
 
 
 @admin_bp.route('/user/<int:user_id>/extend', methods=['POST'])
-@login_required
 @admin_required
 def extend_subscription(user_id):
-    from proc_detracciones.models import UserPlanSubscription, Plan
+    from proc_detracciones.models import Plan
     
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     months = int(request.form.get('months', 0))
     plan_id = int(request.form.get('plan_id'))
     
@@ -190,7 +307,7 @@ def extend_subscription(user_id):
         flash('Los meses no pueden ser negativos', 'warning')
         return redirect(url_for('admin.users_list'))
         
-    plan = Plan.query.get_or_404(plan_id)
+    plan = db.get_or_404(Plan, plan_id)
     now = datetime.now(timezone.utc)
     days = months * 30
     
@@ -201,30 +318,15 @@ def extend_subscription(user_id):
         # Extender la suscripción existente del mismo plan
         active_sub.ends_at = active_sub.ends_at + timedelta(days=days)
         end_date = active_sub.ends_at
+        _apply_plan_status(user, plan)
     else:
-        # ✅ DESACTIVAR SUSCRIPCIONES ANTERIORES
-        UserPlanSubscription.query.filter_by(user_id=user.id, is_active=True).update({'is_active': False})
-        db.session.flush()
-        
         # Crear una nueva suscripción con el plan diferente
-        new_sub = UserPlanSubscription(
-            user_id=user.id,
-            plan_id=plan_id,
-            starts_at=now,
-            ends_at=now + timedelta(days=days) if days > 0 else (active_sub.ends_at if active_sub else now + timedelta(days=2)),
-            is_active=True,
-            auto_renew=False
-        )
-        db.session.add(new_sub)
+        ends_at = now + timedelta(days=days) if days > 0 else (active_sub.ends_at if active_sub else now + timedelta(days=2))
+        new_sub = _replace_subscription(user, plan, now, ends_at)
         end_date = new_sub.ends_at
     
-    # ✅ ACTUALIZAR ESTADO SEGÚN EL TIPO DE PLAN
-    if plan.slug and 'trial' in plan.slug.lower():
-        user.account_status = 'TRIAL_ACTIVO'
-    else:
-        user.account_status = 'ACTIVO'
-    
     db.session.commit()
+    user.clear_plan_cache()
     
     flash(f'Suscripción actualizada por {months} mes(es) con el plan "{plan.name}". Vencimiento: {end_date.strftime("%d/%m/%Y %H:%M")}', 'success')
     return redirect(url_for('admin.users_list'))
@@ -232,52 +334,64 @@ def extend_subscription(user_id):
 
 
 @admin_bp.route('/export-users')
-@login_required
 @admin_required
 def export_users():
-    users = User.query.all()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    writer.writerow([
-        'ID', 'Username', 'Email', 'Nombre', 'Apellido', 
-        'Estado', 'Rol', 'Meses Pagados', 'Inicio Suscripción', 
-        'Vencimiento', 'Último Pago', 'Email Verificado', 'Fecha Registro'
-    ])
-    
-    for user in users:
-        active_sub = user.get_active_subscription()
+    # Se genera y envía por trozos: nunca está el CSV entero en memoria y los
+    # usuarios se leen de a _EXPORT_CHUNK con un cursor del lado del servidor
+    def generate():
+        output = io.StringIO()
+        writer = csv.writer(output)
+
+        def flush(prefix=''):
+            data = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return (prefix + data).encode('utf-8')
+
         writer.writerow([
-            user.id,
-            user.username or '',
-            user.email or '',
-            user.first_name or '',
-            user.last_name or '',
-            user.account_status or '',
-            user.role or '',
-            active_sub.plan.name if active_sub else '',
-            active_sub.starts_at.strftime('%d/%m/%Y %H:%M') if active_sub else '',
-            active_sub.ends_at.strftime('%d/%m/%Y %H:%M') if active_sub else '',
-            '',  # Ya no hay last_payment_date
-            'Sí' if user.is_email_verified else 'No',
-            user.created_at.strftime('%d/%m/%Y %H:%M') if user.created_at else ''
+            'ID', 'Username', 'Email', 'Nombre', 'Apellido', 
+            'Estado', 'Rol', 'Meses Pagados', 'Inicio Suscripción', 
+            'Vencimiento', 'Último Pago', 'Email Verificado', 'Fecha Registro'
         ])
-    
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8-sig')),
+        yield flush('\ufeff')  # BOM: Excel abre el CSV como UTF-8
+
+        users = db.session.scalars(
+            select(User).options(raiseload('*')).order_by(User.id)
+            .execution_options(stream_results=True, yield_per=_EXPORT_CHUNK)
+        )
+        for chunk in users.partitions():
+            active_subs = _active_subs_by_user([user.id for user in chunk])
+            for user in chunk:
+                active_sub = active_subs.get(user.id)
+                writer.writerow([
+                    user.id,
+                    user.username or '',
+                    user.email or '',
+                    user.first_name or '',
+                    user.last_name or '',
+                    user.account_status or '',
+                    user.role or '',
+                    active_sub.plan.name if active_sub else '',
+                    active_sub.starts_at.strftime('%d/%m/%Y %H:%M') if active_sub else '',
+                    active_sub.ends_at.strftime('%d/%m/%Y %H:%M') if active_sub else '',
+                    '',  # Ya no hay last_payment_date
+                    'Sí' if user.is_email_verified else 'No',
+                    user.created_at.strftime('%d/%m/%Y %H:%M') if user.created_at else ''
+                ])
+            yield flush()
+
+    filename = f'usuarios_{datetime.now().strftime("%Y%m%d_%H%M")}.csv'
+    return Response(
+        stream_with_context(generate()),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name=f'usuarios_{datetime.now().strftime("%Y%m%d_%H%M")}.csv'
+        headers={'Content-Disposition': f'attachment; filename={filename}'},
     )
 
 
 @admin_bp.route('/user/<int:user_id>/make-admin', methods=['POST'])
-@login_required
 @admin_required
 def make_admin(user_id):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
     if user.role == 'admin':
         flash(f'{user.email} ya es administrador', 'info')
@@ -289,13 +403,11 @@ def make_admin(user_id):
     return redirect(url_for('admin.users_list'))
 
 @admin_bp.route('/user/<int:user_id>/remove-admin', methods=['POST'])
-@login_required
 @admin_required
 def remove_admin(user_id):
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
-    admin_count = User.query.filter_by(role='admin').count()
-    if admin_count <= 1:
+    if not _has_other_admin(user.id):
         flash('No puedes quitar el rol admin al último administrador', 'danger')
         return redirect(url_for('admin.users_list'))
     
@@ -307,12 +419,9 @@ def remove_admin(user_id):
 
 
 @admin_bp.route('/user/<int:user_id>/delete', methods=['POST'])
-@login_required
 @admin_required
 def delete_user(user_id):
-    from proc_detracciones.models import UserPlanSubscription, ServiceUsageLog
-    
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
     # Evitar que el admin se elimine a sí mismo
     if user.id == current_user.id:
@@ -321,19 +430,18 @@ def delete_user(user_id):
     
     # Evitar eliminar al último admin
     if user.role == 'admin':
-        admin_count = User.query.filter_by(role='admin').count()
-        if admin_count <= 1:
+        if not _has_other_admin(user.id):
             flash('No puedes eliminar al último administrador del sistema', 'danger')
             return redirect(url_for('admin.users_list'))
     
     email = user.email
     
     try:
-        # Eliminar suscripciones del usuario
-        UserPlanSubscription.query.filter_by(user_id=user.id).delete()
-        
-        # Eliminar logs de uso (opcional, o puedes mantenerlos para auditoría)
-        ServiceUsageLog.query.filter_by(user_id=user.id).delete()
+        # Suscripciones (y sus contadores), logs de uso, tokens y revisiones
+        # los resuelven las FKs (ON DELETE CASCADE / SET NULL) en el mismo
+        # DELETE. SQLite no aplica FKs (sin PRAGMA foreign_keys): ahí a mano.
+        if db.session.get_bind().dialect.name == 'sqlite':
+            _delete_user_dependents(user.id)
         
         # Ahora sí eliminar al usuario
         db.session.delete(user)
@@ -349,7 +457,6 @@ def delete_user(user_id):
 
 
 @admin_bp.route('/plan/create', methods=['GET', 'POST'])
-@login_required
 @admin_required
 def plan_create():
     from proc_detracciones.models import Plan, Service, PlanServiceQuota
@@ -416,21 +523,11 @@ def plan_create():
             db.session.add(plan)
             db.session.flush()
             
-            # Crear quotas solo para servicios seleccionados
-            for service_id in selected_services:
-                service_id = int(service_id)
-                xml_quota = int(request.form.get(f'xml_quota_{service_id}', '-1'))
-                runs_quota = int(request.form.get(f'runs_quota_{service_id}', '-1'))
-                
-                quota = PlanServiceQuota(
-                    plan_id=plan.id,
-                    service_id=service_id,
-                    xml_quota=xml_quota,
-                    runs_quota=runs_quota
-                )
-                db.session.add(quota)
+            # Crear quotas solo para servicios seleccionados (un INSERT multi-fila)
+            db.session.execute(db.insert(PlanServiceQuota), _quota_rows(plan.id, selected_services))
             
             db.session.commit()
+            _forget_active_plans()
             flash(f'Plan "{name}" creado exitosamente', 'success')
             return redirect(url_for('admin.plans_list'))
             
@@ -445,11 +542,14 @@ def plan_create():
 
 
 @admin_bp.route('/plans')
-@login_required
 @admin_required
 def plans_list():
-    from proc_detracciones.models import Plan, Service
-    plans = Plan.query.order_by(Plan.created_at.desc()).all()
+    from proc_detracciones.models import Plan, Service, PlanServiceQuota
+    # La plantilla lista las cuotas de cada plan con el nombre del servicio
+    plans = Plan.query.options(
+        selectinload(Plan.service_quotas).joinedload(PlanServiceQuota.service),
+        raiseload('*'),
+    ).order_by(Plan.created_at.desc()).all()
     services = Service.query.filter_by(is_active=True).all()
     return render_template('admin/plans.html', plans=plans, services=services)
 
@@ -457,12 +557,11 @@ def plans_list():
 
 
 @admin_bp.route('/plan/<int:plan_id>/edit', methods=['GET', 'POST'])
-@login_required
 @admin_required
 def plan_edit(plan_id):
     from proc_detracciones.models import Plan, Service, PlanServiceQuota
     
-    plan = Plan.query.get_or_404(plan_id)
+    plan = db.get_or_404(Plan, plan_id, options=[selectinload(Plan.service_quotas)])
     
     if request.method == 'POST':
         try:
@@ -510,26 +609,18 @@ def plan_edit(plan_id):
             PlanServiceQuota.query.filter_by(plan_id=plan.id).delete()
             
             # Crear/actualizar quotas solo para servicios seleccionados
-            for service_id in selected_services:
-                service_id = int(service_id)
-                xml_quota = int(request.form.get(f'xml_quota_{service_id}', '-1'))
-                runs_quota = int(request.form.get(f'runs_quota_{service_id}', '-1'))
-                
-                quota = PlanServiceQuota(
-                    plan_id=plan.id,
-                    service_id=service_id,
-                    xml_quota=xml_quota,
-                    runs_quota=runs_quota
-                )
-                db.session.add(quota)
+            db.session.execute(db.insert(PlanServiceQuota), _quota_rows(plan.id, selected_services))
             
             db.session.commit()
+            _forget_active_plans()
             flash(f'Plan "{plan.name}" actualizado', 'success')
             return redirect(url_for('admin.plans_list'))
             
         except Exception as e:
             db.session.rollback()
             flash(f'Error al actualizar el plan: {str(e)}', 'danger')
+            # El rollback expiró el plan: recargarlo con sus cuotas para el formulario
+            plan = db.get_or_404(Plan, plan_id, options=[selectinload(Plan.service_quotas)])
             services = Service.query.filter_by(is_active=True).all()
             return render_template('admin/plan_form.html', plan=plan, services=services)
     
@@ -537,16 +628,19 @@ def plan_edit(plan_id):
     return render_template('admin/plan_form.html', plan=plan, services=services)
 
 @admin_bp.route('/plan/<int:plan_id>/delete', methods=['POST'])
-@login_required
 @admin_required
 def plan_delete(plan_id):
     from proc_detracciones.models import Plan
     
-    plan = Plan.query.get_or_404(plan_id)
+    # delete() necesita ambas colecciones (cascade de cuotas y FK de suscripciones)
+    plan = db.get_or_404(
+        Plan, plan_id, options=[selectinload(Plan.service_quotas), selectinload(Plan.subscriptions)]
+    )
     name = plan.name
     
     db.session.delete(plan)
     db.session.commit()
+    _forget_active_plans()
     
     flash(f'Plan "{name}" eliminado', 'warning')
     return redirect(url_for('admin.plans_list'))
@@ -554,15 +648,13 @@ def plan_delete(plan_id):
 # ==================== GESTIÓN DE SERVICIOS ====================
 
 @admin_bp.route('/services')
-@login_required
 @admin_required
 def services_list():
     from proc_detracciones.models import Service
-    services = Service.query.order_by(Service.created_at.desc()).all()
+    services = Service.query.options(raiseload('*')).order_by(Service.created_at.desc()).all()
     return render_template('admin/services.html', services=services)
 
 @admin_bp.route('/service/create', methods=['GET', 'POST'])
-@login_required
 @admin_required
 def service_create():
     from proc_detracciones.models import Service
@@ -586,12 +678,11 @@ def service_create():
     return render_template('admin/service_form.html', service=None)
 
 @admin_bp.route('/service/<int:service_id>/edit', methods=['GET', 'POST'])
-@login_required
 @admin_required
 def service_edit(service_id):
     from proc_detracciones.models import Service
     
-    service = Service.query.get_or_404(service_id)
+    service = db.get_or_404(Service, service_id)
     
     if request.method == 'POST':
         service.name = request.form.get('name', '').strip()
@@ -606,12 +697,11 @@ def service_edit(service_id):
 
 
 @admin_bp.route('/user/<int:user_id>/edit-subscription', methods=['POST'])
-@login_required
 @admin_required
 def edit_subscription(user_id):
-    from proc_detracciones.models import UserPlanSubscription, Plan
+    from proc_detracciones.models import Plan
     
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     months = int(request.form.get('months', 1))
     plan_id = int(request.form.get('plan_id'))
     
@@ -619,7 +709,7 @@ def edit_subscription(user_id):
         flash('Los meses no pueden ser negativos', 'warning')
         return redirect(url_for('admin.users_list'))
         
-    plan = Plan.query.get_or_404(plan_id)
+    plan = db.get_or_404(Plan, plan_id)
     now = datetime.now(timezone.utc)
     
     # Para trial, si months=0, usar trial_days del plan
@@ -628,42 +718,40 @@ def edit_subscription(user_id):
     else:
         days = months * 30 if months > 0 else 2  # Mínimo 2 días
     
-    # ✅ DESACTIVAR TODAS las suscripciones anteriores
-    UserPlanSubscription.query.filter_by(user_id=user.id, is_active=True).update({'is_active': False})
-    db.session.flush()
-    
     # ✅ CREAR nueva suscripción con fecha DESDE HOY
-    new_sub = UserPlanSubscription(
-        user_id=user.id,
-        plan_id=plan_id,
-        starts_at=now,
-        ends_at=now + timedelta(days=days),
-        is_active=True,
-        auto_renew=False
-    )
-    db.session.add(new_sub)
-    
-    # ✅ ACTUALIZAR ESTADO SEGÚN EL TIPO DE PLAN
-    if plan.slug and 'trial' in plan.slug.lower():
-        user.account_status = 'TRIAL_ACTIVO'
-    else:
-        user.account_status = 'ACTIVO'
-    
+    new_sub = _replace_subscription(user, plan, now, now + timedelta(days=days))
     db.session.commit()
+    user.clear_plan_cache()
     
     flash(f'Suscripción editada: {months} mes(es) con el plan "{plan.name}". Vencimiento: {new_sub.ends_at.strftime("%d/%m/%Y %H:%M")}', 'success')
     return redirect(url_for('admin.users_list'))
 
 
 @admin_bp.route('/magic-links', methods=['GET'])
-@login_required
 @admin_required
 def magic_links_list():
     """Página para generar y ver magic links"""
     from proc_detracciones.models import AuthToken
-    
-    # Obtener todos los magic links creados (últimos 50)
-    tokens = AuthToken.query.filter_by(purpose='invite_trial').order_by(AuthToken.created_at.desc()).limit(50).all()
+    from sqlalchemy import select
+    from sqlalchemy.orm import Bundle
+    
+    # Obtener todos los magic links creados (últimos 50). Es solo lectura:
+    # filas livianas (Bundle) en vez de instancias ORM; la plantilla sigue
+    # leyendo token.<campo> y token.user.<campo>
+    token_row = Bundle(
+        'token',
+        AuthToken.id, AuthToken.created_at, AuthToken.reference_note,
+        AuthToken.revoked, AuthToken.used_count, AuthToken.max_uses,
+        AuthToken.expires_at, AuthToken.magic_link_url,
+        Bundle('user', User.username, User.email),
+    )
+    tokens = db.session.execute(
+        select(token_row)
+        .outerjoin(AuthToken.user)
+        .where(AuthToken.purpose == 'invite_trial')
+        .order_by(AuthToken.created_at.desc())
+        .limit(50)
+    ).scalars().all()
 
     now = datetime.now()  # ✅ AGREGAR ESTA LÍNEA
     
@@ -672,7 +760,6 @@ def magic_links_list():
 
 
 @admin_bp.route('/magic-links/generate', methods=['POST'])
-@login_required
 @admin_required
 def generate_magic_link():
     """Genera un nuevo magic link"""
@@ -690,17 +777,12 @@ def generate_magic_link():
     
     try:
         # Generar el magic link
-        link = create_magic_link(username, purpose='invite_trial', created_by_admin_id=current_user.id)
+        link, token = create_magic_link(username, purpose='invite_trial', created_by_admin_id=current_user.id)
         
-        # Guardar la referencia Y el link en el token
-        from proc_detracciones.models import AuthToken
-        user = User.query.filter_by(username=username).first()
-        if user:
-            token = AuthToken.query.filter_by(user_id=user.id, purpose='invite_trial').order_by(AuthToken.created_at.desc()).first()
-            if token:
-                token.reference_note = reference_note
-                token.magic_link_url = link  # ✅ GUARDAR EL LINK COMPLETO
-                db.session.commit()
+        # Guardar la referencia Y el link en el token recién creado
+        token.reference_note = reference_note
+        token.magic_link_url = link  # ✅ GUARDAR EL LINK COMPLETO
+        db.session.commit()
         
         flash(f'✅ Magic Link generado exitosamente para: {reference_note or username}', 'success')
         return redirect(url_for('admin.magic_links_list'))
@@ -711,13 +793,12 @@ def generate_magic_link():
     
 
 @admin_bp.route('/magic-links/revoke/<int:token_id>', methods=['POST'])
-@login_required
 @admin_required
 def revoke_magic_link(token_id):
     """Revocar un magic link"""
     from proc_detracciones.models import AuthToken
     
-    token = AuthToken.query.get_or_404(token_id)
+    token = db.get_or_404(AuthToken, token_id, options=[joinedload(AuthToken.user)])
     
     if token.purpose != 'invite_trial':
         flash('❌ Solo se pueden revocar magic links de trial', 'danger')
@@ -727,8 +808,9 @@ def revoke_magic_link(token_id):
         flash('⚠️ Este magic link ya estaba revocado', 'warning')
         return redirect(url_for('admin.magic_links_list'))
     
+    username = token.user.username
     token.revoked = True
     db.session.commit()
     
-    flash(f'✅ Magic link revocado exitosamente (Usuario: {token.user.username})', 'success')
+    flash(f'✅ Magic link revocado exitosamente (Usuario: {username})', 'success')
     return redirect(url_for('admin.magic_links_list'))
\ No newline at end of file
@@ -21,7 +21,8 @@ from flask import (
 )
 from flask_login import login_required, login_user, logout_user, current_user
 from flask_wtf import FlaskForm
-from sqlalchemy import func
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import joinedload, selectinload
 from wtforms import StringField
 from wtforms.validators import Length
 
@@ -39,11 +40,8 @@ def _coerce_utc(dt: datetime | None) -> datetime | None:
     return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
 
 def _get_tz():
-    name = current_app.config.get("TRIAL_TZ", "America/Lima")
-    try:
-        return ZoneInfo(name)
-    except Exception:
-        return timezone.utc
+    # Resuelta una vez en create_app()
+    return current_app.extensions["trial_tz"]
 
 def _fmt_local(dt, with_label=False):
     if dt is None:
@@ -53,9 +51,8 @@ def _fmt_local(dt, with_label=False):
     return f"{s} (hora de Lima)" if with_label else s
 
 def _token_ttl() -> timedelta:
-    secs = int(current_app.config.get("MAGIC_TOKEN_TTL_SECONDS", 0) or 0)
-    hrs  = int(current_app.config.get("MAGIC_TOKEN_TTL_HOURS", 24) or 0)
-    return timedelta(seconds=secs) if secs > 0 else timedelta(hours=hrs)
+    # Resuelto una vez en create_app()
+    return current_app.extensions["trial_defaults"]["token_ttl"]
 
 @auth_bp.get("/login")
 def login():
@@ -70,6 +67,8 @@ def login_post():
     if not user or not user.check_password(password):
         flash("Credenciales inválidas.", "danger")
         return redirect(url_for("auth.login"))
+    if db.session.is_modified(user):
+        db.session.commit()  # hash legado migrado a Argon2 en check_password
 
     login_user(user, remember=True)
     
@@ -84,8 +83,9 @@ def logout():
     logout_user()
     return redirect(url_for("auth.login"))
 
-def _hash_token(raw: str) -> str:
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+def _hash_token(raw: str) -> bytes:
+    # SHA-256 crudo (32 bytes): la mitad que el hex en la columna y en su índice
+    return hashlib.sha256(raw.encode("utf-8")).digest()
 
 def _find_user_by_ident(ident: str) -> User | None:
     ident = (ident or "").strip().lower()
@@ -93,26 +93,10 @@ def _find_user_by_ident(ident: str) -> User | None:
         return User.query.filter(func.lower(User.email) == ident).first()
     return User.query.filter(func.lower(User.username) == ident).first()
 
-def _apply_trial_quotas_only(user: User) -> None:
-    if getattr(user, "xml_quota", None) is None:
-        user.xml_quota = 10
-    if getattr(user, "runs_quota", None) is None:
-        user.runs_quota = 2
-    if getattr(user, "xml_used", None) is None:
-        user.xml_used = 0
-    if getattr(user, "runs_used", None) is None:
-        user.runs_used = 0
-
 def _ensure_trial_defaults_on_first_use(user: User) -> None:
     if getattr(user, "trial_ends_at", None) is not None:
         return
-    s = int(current_app.config.get("TRIAL_SECONDS", 0) or 0)
-    m = int(current_app.config.get("TRIAL_MINUTES", 0) or 0)
-    h = int(current_app.config.get("TRIAL_HOURS", 0) or 0)
-    d = int(current_app.config.get("TRIAL_DAYS", 14) or 0)
-    delta = timedelta(seconds=s, minutes=m, hours=h, days=d)
-    if delta.total_seconds() <= 0:
-        delta = timedelta(days=int(current_app.config.get("TRIAL_DAYS", 14)))
+    delta = current_app.extensions["trial_defaults"]["trial_delta"]
     
     # Obtener la fecha actual en la zona horaria de Lima
     tz = _get_tz()
@@ -127,7 +111,12 @@ def _ensure_trial_defaults_on_first_use(user: User) -> None:
 
 
 
-def create_magic_link(ident: str, purpose: str = "invite_trial", created_by_admin_id=None) -> str:
+def create_magic_link(ident: str, purpose: str = "invite_trial", created_by_admin_id=None) -> tuple[str, AuthToken]:
+    """Emite un token para ident (creando el usuario trial si es invitación).
+
+    Devuelve (link, token): quien llama puede completar el token (nota,
+    link guardado) sin volver a buscarlo.
+    """
     from proc_detracciones.models import Plan, UserPlanSubscription
     from datetime import timedelta
     
@@ -150,7 +139,6 @@ def create_magic_link(ident: str, purpose: str = "invite_trial", created_by_admi
         user.is_email_verified = True if "@" in ident else False
         user.email_verified_at = _utcnow() if "@" in ident else None
         
-        ###_apply_trial_quotas_only(user)
         db.session.add(user)
         db.session.flush()  # Obtener el user.id
         
@@ -207,6 +195,10 @@ def create_magic_link(ident: str, purpose: str = "invite_trial", created_by_admi
     db.session.add(token)
     db.session.commit()
 
+    return _magic_url(raw), token
+
+
+def _magic_url(raw: str) -> str:
     path = f"/auth/magic?token={raw}"
     if has_request_context():
         return url_for("auth.magic_get", token=raw, _external=True)
@@ -215,6 +207,51 @@ def create_magic_link(ident: str, purpose: str = "invite_trial", created_by_admi
     return f"{scheme}://{server}{path}"
 
 
+def create_trial_users_bulk(usernames: list[str]) -> list[tuple[str, str]]:
+    """
+    Equivale a create_magic_link(u, "invite_trial") para muchos usernames
+    NUEVOS: usuarios, suscripciones al plan trial y tokens se insertan con un
+    executemany por tabla y un solo commit. Devuelve [(username, link), ...].
+    """
+    from proc_detracciones.models import Plan, UserPlanSubscription
+
+    if not usernames:
+        return []
+
+    db.session.execute(insert(User), [
+        {"username": u, "account_status": "TRIAL_ACTIVO", "is_email_verified": False}
+        for u in usernames
+    ])
+    ids = dict(db.session.execute(
+        select(User.username, User.id).where(User.username.in_(usernames))
+    ).all())
+
+    trial_plan = Plan.query.filter_by(slug='trial-detracciones').first()
+    if trial_plan:
+        # Medianoche de HOY en Lima, guardada en UTC (igual que create_magic_link)
+        lima_tz = ZoneInfo("America/Lima")
+        starts_at = (datetime.now(lima_tz)
+                     .replace(hour=0, minute=0, second=0, microsecond=0)
+                     .astimezone(timezone.utc))
+        ends_at = starts_at + timedelta(days=trial_plan.trial_days) if trial_plan.trial_days else None
+        db.session.execute(insert(UserPlanSubscription), [
+            {"user_id": ids[u], "plan_id": trial_plan.id, "starts_at": starts_at,
+             "ends_at": ends_at, "is_active": True, "auto_renew": False}
+            for u in usernames
+        ])
+
+    expires_at = _utcnow() + _token_ttl()
+    raws = {u: secrets.token_urlsafe(32) for u in usernames}
+    db.session.execute(insert(AuthToken), [
+        {"user_id": ids[u], "purpose": "invite_trial", "token_hash": _hash_token(raws[u]),
+         "expires_at": expires_at, "max_uses": 1, "revoked": False}
+        for u in usernames
+    ])
+    db.session.commit()
+
+    return [(u, _magic_url(raws[u])) for u in usernames]
+
+
 
 
 
@@ -224,7 +261,7 @@ def magic_get():
     if not raw:
         flash("Token ausente.", "danger")
         return redirect(url_for("auth.login"))
-    t = AuthToken.query.filter_by(token_hash=_hash_token(raw)).first()
+    t = AuthToken.query.options(joinedload(AuthToken.user)).filter_by(token_hash=_hash_token(raw)).first()
     if not t or t.revoked or t.used_count >= t.max_uses:
         flash("Token inválido o expirado.", "danger")
         return redirect(url_for("auth.login"))
@@ -252,7 +289,7 @@ def magic_post():
         flash("Token ausente.", "danger")
         return redirect(url_for("auth.login"))
     
-    t = AuthToken.query.filter_by(token_hash=_hash_token(raw)).first()
+    t = AuthToken.query.options(joinedload(AuthToken.user)).filter_by(token_hash=_hash_token(raw)).first()
     if not t or t.revoked or t.used_count >= t.max_uses:
         flash("Token inválido o expirado.", "danger")
         return redirect(url_for("auth.login"))
@@ -263,7 +300,6 @@ def magic_post():
         return redirect(url_for("auth.login"))
     
     user = t.user
-    ##_apply_trial_quotas_only(user)
     _ensure_trial_defaults_on_first_use(user)
     
     user.account_status = 'TRIAL_ACTIVO'
@@ -296,6 +332,7 @@ def magic_post():
                 auto_renew=False
             )
             db.session.add(trial_sub)
+            user.clear_plan_cache()
     
     login_user(user, remember=True)
     t.used_count += 1
@@ -391,7 +428,6 @@ def register_post():
     )
     
     u.set_password(password)
-    _apply_trial_quotas_only(u)
     
     # Verificar si el email es admin
     if u.email and u.email.lower() in [e.strip().lower() for e in current_app.config.get('ADMIN_EMAILS', [])]:
@@ -423,6 +459,13 @@ def upgrade():
     if current_user.account_status == 'ACTIVO':
         active_sub = current_user.get_active_subscription()
         if active_sub:
+            from proc_detracciones.models import Plan, PlanServiceQuota
+            # plan_status recorre las cuotas del plan y el nombre de cada servicio
+            db.session.execute(
+                select(Plan).where(Plan.id == active_sub.plan_id).options(
+                    selectinload(Plan.service_quotas).joinedload(PlanServiceQuota.service)
+                )
+            ).scalar_one()
             return render_template("plan_status.html", subscription=active_sub)
     
     # Si no está activo, mostrar el proceso de upgrade
@@ -651,8 +694,8 @@ Soluciones Informáticas
 
 @auth_bp.route('/verify-email/<token>')
 def verify_email(token):
-    t = AuthToken.query.filter_by(
-        token_hash=hashlib.sha256(token.encode()).hexdigest(),
+    t = AuthToken.query.options(joinedload(AuthToken.user)).filter_by(
+        token_hash=_hash_token(token),
         purpose="verify_email",
         revoked=False
     ).first()
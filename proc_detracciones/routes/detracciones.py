@@ -2,25 +2,45 @@
 import os
 # proc_detracciones/routes/detracciones.py
 import os
-import io
+import re
+import shutil
 import zipfile
 from io import BytesIO
 from decimal import Decimal
 from datetime import datetime, timezone
 from tempfile import TemporaryDirectory
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Blueprint, request, send_file, render_template, make_response, current_app, redirect, url_for, flash
+from flask import Blueprint, request, send_file, render_template, make_response, current_app, redirect, url_for, flash, after_this_request
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 
-from zoneinfo import ZoneInfo
 
 from ..extensions import db
-from ..services.procesador import run_pipeline
+from ..services.procesador import run_pipeline, extract_zips
 from ..models import User  # <-- ASEGÚRATE DE QUE ESTA LÍNEA ESTÉ PRESENTE
 
 detracciones_bp = Blueprint("detracciones", __name__, url_prefix="/services/detracciones")
 
+# Asumimos que el servicio de detracciones tiene ID=1
+DETRACCIONES_SERVICE_ID = 1
+
+# Buffer para volcar las subidas a disco (Werkzeug usa 16 KB por defecto)
+UPLOAD_BUFSIZE = 1024 * 1024
+
+# Lote: exactamente 6 dígitos ASCII (str.isdigit acepta también "²", "٣", ...)
+LOTE_RE = re.compile(r"[0-9]{6}")
+
+# Hilos para volcar a disco varios XML sueltos a la vez (copias archivo→archivo)
+UPLOAD_SAVE_WORKERS = 4
+
+# Parámetros fijos del pipeline para la web (se crean una sola vez)
+MIN_MONTO = Decimal("700.00")
+EMPTY_WHITELIST = frozenset()
+# Los XML comprimen ~10:1; espacio que se exige en SCRATCH_DIR por byte subido
+SCRATCH_EXPANSION = 10
+
 def _utcnow():
     return datetime.now(timezone.utc)
 
@@ -30,11 +50,8 @@ def _coerce_utc(dt):
     return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
 
 def _get_tz():
-    name = current_app.config.get("TRIAL_TZ", "America/Lima")
-    try:
-        return ZoneInfo(name)
-    except Exception:
-        return timezone.utc
+    # Resuelta una vez en create_app()
+    return current_app.extensions["trial_tz"]
 
 def _fmt_local(dt):
     if dt is None:
@@ -45,18 +62,71 @@ def _error_html(message: str, status: int = 400):
     html = f"<!doctype html><html><body><div>{message}</div></body></html>"
     return make_response(html, status, {"Content-Type": "text/html; charset=utf-8"})
 
-def _count_xml_in_filestorage(fs) -> int:
-    data = fs.read()
-    fs.stream = io.BytesIO(data)
+def _save_upload(fs, path: str) -> str:
+    """Vuelca el archivo subido directo al directorio de trabajo (sin copiarlo a memoria)."""
+    fs.save(path, buffer_size=UPLOAD_BUFSIZE)
+    return path
+
+def _scratch_root():
+    """
+    SCRATCH_DIR (tmpfs) si le cabe la subida ya descomprimida; si no (p.ej. el
+    /dev/shm de 64 MB de Docker), None para usar el temp por defecto.
+    """
+    root = current_app.config.get("SCRATCH_DIR")
+    if not root:
+        return None
+    try:
+        free = shutil.disk_usage(root).free
+    except OSError:
+        return None
+    needed = (request.content_length or 0) * SCRATCH_EXPANSION
+    return root if free > needed else None
+
+@contextmanager
+def _request_tempdir():
+    """
+    TemporaryDirectory cuyo borrado (miles de XML extraídos) se difiere hasta
+    que se termina de enviar la respuesta. Si la vista falla, se borra al toque.
+    """
+    tmp = TemporaryDirectory(dir=_scratch_root())
+    try:
+        yield tmp.name
+    except BaseException:
+        tmp.cleanup()
+        raise
+
+    @after_this_request
+    def _cleanup_on_close(resp):
+        resp.call_on_close(tmp.cleanup)
+        return resp
+
+
+def _add_to_zip(z: zipfile.ZipFile, path: str, arcname: str) -> None:
+    """Copia un archivo al ZIP en bloques grandes (ZipFile.write usa 8 KiB)."""
+    with open(path, "rb") as src, z.open(arcname, "w", force_zip64=True) as dst:
+        shutil.copyfileobj(src, dst, UPLOAD_BUFSIZE)
+
+
+def _is_zip(fs) -> bool:
+    return (fs.filename or "").lower().endswith(".zip")
+
+def _has_valid_signature(fs) -> bool:
+    """Extensión .xml/.zip y primeros bytes coherentes (sin leer el resto del archivo)."""
+    head = fs.stream.read(64)
+    fs.stream.seek(0)
     name = (fs.filename or "").lower()
     if name.endswith(".zip"):
-        n = 0
-        with zipfile.ZipFile(io.BytesIO(data)) as z:
-            for member in z.namelist():
-                if member.lower().endswith(".xml"):
-                    n += 1
-        return n
-    return 1
+        return head.startswith((b"PK\x03\x04", b"PK\x05\x06"))  # ZIP (o ZIP vacío)
+    if name.endswith(".xml"):
+        if head.startswith((b"\xff\xfe", b"\xfe\xff")):  # XML en UTF-16
+            return True
+        return head.removeprefix(b"\xef\xbb\xbf").lstrip().startswith(b"<")
+    return False
+
+def _count_xml_in_zip(fs) -> int:
+    # Solo lee el directorio central del ZIP, no descomprime nada
+    with zipfile.ZipFile(fs.stream) as z:
+        return sum(1 for member in z.namelist() if member.lower().endswith(".xml"))
 
 @detracciones_bp.get("/")
 @login_required
@@ -78,43 +148,25 @@ def form():
     active_sub = current_user.get_active_subscription()
     
     # Obtener cuota del servicio de detracciones (ID=1)
-    DETRACCIONES_SERVICE_ID = 1
     quota_info = current_user.get_current_quota(DETRACCIONES_SERVICE_ID)
 
-    # Obtener info de runs (ejecuciones)
+    # Obtener info de runs (ejecuciones SOLO desde que inició el plan actual:
+    # las lleva el mismo contador que los XML)
     runs_info = None
-    if active_sub:
-        from proc_detracciones.models import PlanServiceQuota, ServiceUsageLog
-        
-        plan_quota = PlanServiceQuota.query.filter_by(
-            plan_id=active_sub.plan_id,
-            service_id=DETRACCIONES_SERVICE_ID
-        ).first()
-        
-        if plan_quota:
-            # Contar ejecuciones SOLO desde que inició el plan actual
-            runs_used = ServiceUsageLog.query.filter(
-                ServiceUsageLog.user_id == current_user.id,
-                ServiceUsageLog.service_id == DETRACCIONES_SERVICE_ID,
-                ServiceUsageLog.completed_at >= active_sub.starts_at
-            ).count()
-            
-            runs_info = {
-                'quota': plan_quota.runs_quota,
-                'used': runs_used,
-                'remaining': plan_quota.runs_quota - runs_used if plan_quota.runs_quota != -1 else 'ilimitado',
-                'is_unlimited': plan_quota.runs_quota == -1
-            }
+    runs_quota = quota_info['runs_quota']
+    if active_sub and runs_quota is not None:
+        runs_used = quota_info['runs_used']
+        runs_info = {
+            'quota': runs_quota,
+            'used': runs_used,
+            'remaining': runs_quota - runs_used if runs_quota != -1 else 'ilimitado',
+            'is_unlimited': runs_quota == -1
+        }
     
     # Calcular fecha de vencimiento
     trial_expires_local = None
     if active_sub and active_sub.ends_at:
-        tzname = current_app.config.get("TRIAL_TZ", "America/Lima")
-        try:
-            tz = ZoneInfo(tzname)
-        except Exception:
-            tz = timezone.utc
-        trial_expires_local = active_sub.ends_at.astimezone(tz).strftime('%d/%m/%Y a las %H:%M')
+        trial_expires_local = active_sub.ends_at.astimezone(_get_tz()).strftime('%d/%m/%Y a las %H:%M')
     
     return render_template("detracciones.html", 
                          trial_expires_local=trial_expires_local,
@@ -123,6 +175,36 @@ def form():
                          active_sub=active_sub)
 
 
+def _check_quota(total_xml_a_subir: int):
+    """Devuelve la respuesta de error si el usuario excede sus cuotas, o None."""
+    # Obtener la cuota actual del usuario para el servicio de detracciones
+    quota_info = current_user.get_current_quota(DETRACCIONES_SERVICE_ID)
+
+    # Verificar si el plan es ilimitado
+    if quota_info['is_unlimited']:
+        return None
+
+    # 1. Verificar cuota de XML
+    if quota_info['remaining'] < total_xml_a_subir:
+        return _error_html(
+            f"⚠️ Límite de XML alcanzado. Usados: {quota_info['used']}, Cuota: {quota_info['quota']}. "
+            f"Intentaste subir {total_xml_a_subir} XML adicionales.",
+            403
+        )
+
+    # 2. Verificar cuota de ejecuciones (runs) del período actual
+    runs_quota = quota_info['runs_quota']
+    if runs_quota is not None and runs_quota != -1:
+        runs_used = quota_info['runs_used']
+        if runs_used >= runs_quota:
+            return _error_html(
+                f"⚠️ Límite de ejecuciones alcanzado. Has usado {runs_used} de {runs_quota} ejecuciones permitidas. "
+                f"Actualiza tu plan para continuar.",
+                403
+            )
+    return None
+
+
 @detracciones_bp.post("/")
 @login_required
 def process():
@@ -136,104 +218,103 @@ def process():
     tipo_depositante = request.form.get("tipo_depositante", "adquiriente")
     download_token = request.form.get("download_token", "")
 
+    # Validaciones baratas primero: nada toca disco hasta que pasen
     if not files or not files[0].filename:
         return _error_html("❌ No se seleccionaron archivos.", 400)
-    if not (lote.isdigit() and len(lote) == 6):
+    if not LOTE_RE.fullmatch(lote):
         return _error_html("❌ El lote debe tener 6 dígitos (ej: 250001).", 400)
+    for f in files:
+        if not _has_valid_signature(f):
+            return _error_html(f"❌ Solo se aceptan archivos .xml o .zip válidos: {secure_filename(f.filename or '')}", 400)
 
-    # --- LÓGICA DE VERIFICACIÓN DE CUOTAS NUEVA ---
-    # Asumimos que el servicio de detracciones tiene ID=1
-    DETRACCIONES_SERVICE_ID = 1
-    total_xml_a_subir = 0
+    # Los XML sueltos se escriben una sola vez en disco. Los ZIP no se
+    # guardan: se cuentan desde su directorio central y, si pasan las
+    # cuotas, se descomprimen directo desde el stream de la subida.
+    zip_uploads = [f for f in files if _is_zip(f)]
+    # secure_filename una sola vez por archivo. Mismo nombre destino → solo
+    # el último (como al guardarlos en secuencia), así dos hilos nunca
+    # escriben el mismo archivo; nombres que quedan vacíos se descartan.
+    xml_uploads = {}
+    for f in files:
+        if not _is_zip(f):
+            name = secure_filename(f.filename)
+            if name:
+                xml_uploads[name] = f
 
+    # --- LÓGICA DE VERIFICACIÓN DE CUOTAS NUEVA ---
+    # Se cuenta desde los streams de la subida: un request rechazado no toca disco
     try:
-        for f in files:
-            total_xml_a_subir += _count_xml_in_filestorage(f)
+        total_xml_a_subir = len(xml_uploads) + sum(_count_xml_in_zip(f) for f in zip_uploads)
     except zipfile.BadZipFile:
         return _error_html("❌ El ZIP está dañado o no es válido.", 400)
 
     if not is_admin:
-        from proc_detracciones.models import UserPlanSubscription, PlanServiceQuota
-        
-        # Obtener la cuota actual del usuario para el servicio de detracciones
-        quota_info = current_user.get_current_quota(DETRACCIONES_SERVICE_ID)
-
-        # Verificar si el plan es ilimitado
-        if not quota_info['is_unlimited']:
-            # 1. Verificar cuota de XML
-            if quota_info['remaining'] < total_xml_a_subir:
-                return _error_html(
-                    f"⚠️ Límite de XML alcanzado. Usados: {quota_info['used']}, Cuota: {quota_info['quota']}. "
-                    f"Intentaste subir {total_xml_a_subir} XML adicionales.",
-                    403
-                )
-            
-            # 2. Verificar cuota de ejecuciones (runs)
-            active_sub = current_user.get_active_subscription()
-            if active_sub:
-                plan_quota = PlanServiceQuota.query.filter_by(
-                    plan_id=active_sub.plan_id,
-                    service_id=DETRACCIONES_SERVICE_ID
-                ).first()
-                
-                if plan_quota and plan_quota.runs_quota != -1:
-                    # Contar ejecuciones ya realizadas
-                    from ..models import ServiceUsageLog
-                    runs_used = ServiceUsageLog.query.filter_by(
-                        user_id=current_user.id,
-                        service_id=DETRACCIONES_SERVICE_ID
-                    ).count()
-                    
-                    if runs_used >= plan_quota.runs_quota:
-                        return _error_html(
-                            f"⚠️ Límite de ejecuciones alcanzado. Has usado {runs_used} de {plan_quota.runs_quota} ejecuciones permitidas. "
-                            f"Actualiza tu plan para continuar.",
-                            403
-                        )
-            
-        # TODO: Aquí podrías añadir una lógica similar para las 'runs_quota' si la necesitas en el futuro.
-        # Por ahora, nos enfocamos solo en la cuota de XML.
-
+        quota_error = _check_quota(total_xml_a_subir)
+        if quota_error is not None:
+            return quota_error
     # --- FIN DE LA LÓGICA DE VERIFICACIÓN ---
 
-    with TemporaryDirectory() as input_temp, TemporaryDirectory() as output_temp:
-        for f in files:
-            path = os.path.join(input_temp, secure_filename(f.filename))
-            f.save(path)
+    with _request_tempdir() as work_dir:
+        # Un solo mkdtemp/rmtree por request, con entrada y salida como subcarpetas
+        input_temp = os.path.join(work_dir, "in")
+        output_temp = os.path.join(work_dir, "out")
+        os.mkdir(input_temp)
+        os.mkdir(output_temp)
+
+        xml_targets = [(f, os.path.join(input_temp, name)) for name, f in xml_uploads.items()]
+        if len(xml_targets) > 1:
+            with ThreadPoolExecutor(max_workers=min(UPLOAD_SAVE_WORKERS, len(xml_targets))) as ex:
+                list(ex.map(lambda t: _save_upload(*t), xml_targets))
+        else:
+            for f, path in xml_targets:
+                _save_upload(f, path)
+
+        # Los ZIP se descomprimen en paralelo bajo "_zips"; ante nombres
+        # repetidos gana el último, igual que cuando run_pipeline los extraía.
+        # ("_zips" no choca con nombres subidos: secure_filename quita el "_".)
+        if zip_uploads:
+            try:
+                extract_zips([f.stream for f in zip_uploads], os.path.join(input_temp, "_zips"))
+            except OSError as e:
+                current_app.logger.exception("No se pudieron extraer los ZIP")
+                return _error_html(f"❌ No se pudieron descomprimir los ZIP. Detalle: {e}", 500)
 
         try:
-            run_pipeline(
+            outputs = run_pipeline(
                 input_dir=input_temp,
                 output_dir=output_temp,
                 lote=lote,
-                min_monto=Decimal("700.00"),
+                min_monto=MIN_MONTO,
                 tipo_operacion_txt="01",
                 enforce_code_whitelist=False,
-                code_whitelist=set(),
-                tipo_depositante=tipo_depositante
+                code_whitelist=EMPTY_WHITELIST,
+                tipo_depositante=tipo_depositante,
+                workers=current_app.config.get("PIPELINE_WORKERS", 1)
             )
         except Exception as e:
             return _error_html(f"❌ No se generó el TXT. Detalle: {str(e)}", 400)
 
-        txt_files = [f for f in os.listdir(output_temp) if f.endswith(".txt")]
-        csv_files = [f for f in os.listdir(output_temp) if f == "omitidos.csv"]
-        if not txt_files:
-            return _error_html("❌ No se generó ningún .txt. Revisa los XML y omitidos.csv.", 400)
+        # run_pipeline devuelve las rutas que escribió: no hace falta listar output_temp
+        txt_path, csv_path = outputs["txt"], outputs["csv"]
+        txt_name = os.path.basename(txt_path)
+        zip_name = f"detracciones_{outputs['ruc'] or 'desconocido'}.zip"
 
-        txt_name = txt_files[0]
-        ruc = txt_name[1:12] if len(txt_name) >= 13 else "desconocido"
-        zip_name = f"detracciones_{ruc}.zip"
-        zip_path = os.path.join(output_temp, zip_name)
-
-        with zipfile.ZipFile(zip_path, "w") as z:
-            z.write(os.path.join(output_temp, txt_name), arcname=txt_name)
-            if csv_files:
-                z.write(os.path.join(output_temp, csv_files[0]), arcname=csv_files[0])
+        # El ZIP se arma directo en memoria (TXT + CSV pesan pocos KB) en vez de
+        # escribirlo en output_temp y volver a leerlo para enviarlo.
+        zip_buf = BytesIO()
+        if current_app.config.get("RESULT_ZIP_COMPRESS"):
+            zip_opts = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+        else:
+            zip_opts = {"compression": zipfile.ZIP_STORED}
+        with zipfile.ZipFile(zip_buf, "w", **zip_opts) as z:
+            _add_to_zip(z, txt_path, txt_name)
+            if csv_path:
+                _add_to_zip(z, csv_path, os.path.basename(csv_path))
 
         # --- REGISTRO DEL USO ---
         # Ya no actualizamos campos en el User, sino que registramos el uso en la tabla de logs.
         if not is_admin:
-            from ..models import ServiceUsageLog
+            from ..models import ServiceUsageLog, record_service_usage
             log = ServiceUsageLog(
                 user_id=current_user.id,
                 service_id=DETRACCIONES_SERVICE_ID,
@@ -245,13 +326,13 @@ def process():
                 completed_at=_utcnow()
             )
             db.session.add(log)
+            record_service_usage(current_user.id, DETRACCIONES_SERVICE_ID, total_xml_a_subir)
             db.session.commit()
+            current_user.clear_plan_cache()
         # --- FIN DEL REGISTRO ---
 
-        with open(zip_path, "rb") as fh:
-            data = fh.read()
-
-        resp = send_file(BytesIO(data), as_attachment=True, download_name=zip_name, mimetype="application/zip")
+        zip_buf.seek(0)
+        resp = send_file(zip_buf, as_attachment=True, download_name=zip_name, mimetype="application/zip")
         if download_token:
             resp.set_cookie("fileDownloadToken", download_token, max_age=60, path="/")
         return resp
\ No newline at end of file
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
 import csv
 import glob
+import multiprocessing
 import os
+import shutil
+import threading
 import unicodedata
 import zipfile
 from decimal import Decimal, ROUND_HALF_UP
 import xml.etree.ElementTree as ET
 from tempfile import TemporaryDirectory
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # ---------------------------------------
 # Configuración por defecto
@@ -20,6 +25,9 @@ DEFAULT_CODE_WHITELIST = {
     "022", "030", "037", "039", "040", "041", "042", "043", "044", "045", "046",
     "047", "048", "049", "050", "051", "052", "053", "054", "055"
 }
+DEFAULT_PARSE_WORKERS = 1      # >1 reparte el parseo de XML entre procesos
+PARALLEL_PARSE_MIN_XML = 50    # por debajo de esto no compensa levantar procesos
+COPY_BUFSIZE = 1024 * 1024     # buffer de copia al extraer ZIP (1 MiB)
 
 NS = {
     "inv": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
@@ -79,19 +87,71 @@ def collect_input_files(input_dir: str):
     xmls = list_files_case_insensitive(input_dir, ["**/*.xml", "**/*.XML"])
     return zips, xmls
 
-def extract_xmls_from_zip(zip_path: str, out_dir: str):
+def _xml_members(zip_path):
+    """Miembros .xml del ZIP según su directorio central (no descomprime nada)."""
+    with zipfile.ZipFile(zip_path) as z:
+        return [m for m in z.infolist() if m.filename.lower().endswith(".xml")]
+
+def extract_xmls_from_zip(zip_path, out_dir: str, members=None):
+    """
+    `zip_path` puede ser una ruta o un archivo abierto (p.ej. el stream de una subida).
+    Si el ZIP repite un nombre de archivo solo se extrae el último; `members`
+    permite indicar de antemano qué miembros extraer.
+    """
     extracted = []
     with zipfile.ZipFile(zip_path) as z:
-        for member in z.infolist():
-            if member.filename.lower().endswith(".xml"):
-                data = z.read(member)
-                name = os.path.basename(member.filename)
-                out_path = os.path.join(out_dir, name)
-                with open(out_path, "wb") as f:
-                    f.write(data)
-                extracted.append(out_path)
+        if members is None:
+            members = {os.path.basename(m.filename): m for m in z.infolist()
+                       if m.filename.lower().endswith(".xml")}.values()
+        for member in members:
+            out_path = os.path.join(out_dir, os.path.basename(member.filename))
+            with z.open(member) as src, open(out_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            extracted.append(out_path)
     return extracted
 
+def _extract_zip_safe(zip_path: str, out_dir: str, members=None):
+    ensure_dir(out_dir)
+    # Solo se descarta un ZIP dañado; un OSError (p.ej. disco lleno) se propaga
+    # para no generar un TXT parcial como si fuera completo.
+    try:
+        return extract_xmls_from_zip(zip_path, out_dir, members)
+    except zipfile.BadZipFile as e:
+        print(f"[WARN] ZIP inválido: {zip_path} -> {e}")
+        return []
+
+def extract_zips(zip_paths, out_dir: str):
+    """
+    Extrae los XML de todos los ZIP (rutas o archivos abiertos) en paralelo
+    (hilos: zlib libera el GIL). Cada ZIP usa su propia subcarpeta; si se
+    repite un nombre de archivo gana el último, igual que al extraerlos en
+    secuencia. Los ganadores se eligen antes leyendo solo los directorios
+    centrales, así ningún XML se descomprime ni se escribe dos veces.
+    """
+    winners = {}
+    for i, zp in enumerate(zip_paths):
+        try:
+            members = _xml_members(zp)
+        except zipfile.BadZipFile as e:
+            print(f"[WARN] ZIP inválido: {zp} -> {e}")
+            continue
+        for m in members:
+            winners[os.path.basename(m.filename)] = (i, m)
+
+    per_zip = [[] for _ in zip_paths]
+    for i, m in winners.values():
+        per_zip[i].append(m)
+    jobs = [(zp, os.path.join(out_dir, str(i)), members)
+            for i, (zp, members) in enumerate(zip(zip_paths, per_zip)) if members]
+
+    max_workers = min(len(jobs), os.cpu_count() or 1)
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            results = list(ex.map(lambda job: _extract_zip_safe(*job), jobs))
+    else:
+        results = [_extract_zip_safe(*job) for job in jobs]
+    return [p for paths in results for p in paths]
+
 # ---------------------------------------
 # Parsing UBL 2.1 (Factura)
 # ---------------------------------------
@@ -173,6 +233,75 @@ def parse_xml_fields(path):
         "comprobante": comp_id,
     }
 
+def _parse_xml_safe(path):
+    """Devuelve (rec, None) o (None, mensaje de error); apto para correr en otro proceso."""
+    try:
+        return parse_xml_fields(path), None
+    except Exception as e:
+        return None, str(e)
+
+# Un solo pool por proceso (worker de gunicorn), creado al primer lote grande.
+# Se usa "forkserver": hacer fork() desde un worker con varios hilos puede
+# dejar al hijo bloqueado en un lock que tenía otro hilo.
+_parse_pool = None
+_parse_pool_pid = None
+_parse_pool_lock = threading.Lock()
+
+def _available_cpus() -> int:
+    # sched_getaffinity respeta los CPUs asignados al proceso (cpuset del
+    # contenedor); os.cpu_count() devuelve los del host
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS / Windows
+        return os.cpu_count() or 1
+
+def _get_parse_pool(size: int) -> ProcessPoolExecutor:
+    global _parse_pool, _parse_pool_pid
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool_pid != os.getpid():
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context(method),
+            )
+            _parse_pool_pid = os.getpid()
+        return _parse_pool
+
+@atexit.register
+def _shutdown_parse_pool():
+    if _parse_pool is not None and _parse_pool_pid == os.getpid():
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_xml_files(paths, workers: int = DEFAULT_PARSE_WORKERS):
+    """Parsea los XML en el mismo orden de `paths`, en paralelo si el lote es grande."""
+    if workers > 1 and len(paths) >= PARALLEL_PARSE_MIN_XML:
+        size = max(1, min(workers, _available_cpus()))
+        chunksize = max(1, len(paths) // (size * 4))
+        return list(_get_parse_pool(size).map(_parse_xml_safe, paths, chunksize=chunksize))
+    return [_parse_xml_safe(p) for p in paths]
+
+# Factura mínima que recorre todas las rutas que usa parse_xml_fields
+_WARMUP_XML = (
+    '<Invoice xmlns="%(inv)s" xmlns:cac="%(cac)s" xmlns:cbc="%(cbc)s">'
+    '<cbc:ID>F001-1</cbc:ID>'
+    '<cac:PaymentMeans><cbc:ID>Detraccion</cbc:ID>'
+    '<cac:PayeeFinancialAccount><cbc:ID>0</cbc:ID></cac:PayeeFinancialAccount></cac:PaymentMeans>'
+    '<cac:PaymentTerms><cbc:ID>Detraccion</cbc:ID><cbc:PaymentMeansID>037</cbc:PaymentMeansID>'
+    '<cbc:Amount>0</cbc:Amount></cac:PaymentTerms>'
+    '</Invoice>' % NS
+)
+
+def warmup():
+    """
+    Parsea una factura mínima para que ElementTree deje compiladas (en su caché)
+    las rutas de búsqueda antes del primer request real.
+    """
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "warmup.xml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(_WARMUP_XML)
+        parse_xml_fields(path)
+
 # ---------------------------------------
 # Constructores de detalle (107 bytes)
 # ---------------------------------------
@@ -297,22 +426,18 @@ def run_pipeline(
     tipo_operacion_txt: str = DEFAULT_TIPO_OPERACION_TXT,
     enforce_code_whitelist: bool = False,
     code_whitelist: set[str] = DEFAULT_CODE_WHITELIST,
-    tipo_depositante: str = "proveedor"
+    tipo_depositante: str = "proveedor",
+    workers: int = DEFAULT_PARSE_WORKERS
 ):
     ensure_dir(output_dir)
 
     with TemporaryDirectory() as tmpdir:
         zips, xmls = collect_input_files(input_dir)
-        extracted = []
-        for z in zips:
-            try:
-                extracted.extend(extract_xmls_from_zip(z, tmpdir))
-            except Exception as e:
-                print(f"[WARN] ZIP inválido: {z} -> {e}")
+        extracted = extract_zips(zips, tmpdir)
 
         all_xmls = []
         all_xmls.extend(xmls)
-        all_xmls.extend(list_files_case_insensitive(tmpdir, ["**/*.xml", "**/*.XML"]))
+        all_xmls.extend(extracted)
 
         seen = set()
         final_xmls = []
@@ -329,11 +454,12 @@ def run_pipeline(
         proveedor_ruc, proveedor_razon = "", ""
         cliente_ruc, cliente_razon = "", ""
 
-        for path in sorted(final_xmls):
-            try:
-                rec = parse_xml_fields(path)
-            except Exception as e:
-                add_omit(omitidos, None, os.path.basename(path), f"XML inválido: {e}")
+        final_xmls.sort()
+        parsed = parse_xml_files(final_xmls, workers=workers)
+
+        for path, (rec, error) in zip(final_xmls, parsed):
+            if error is not None:
+                add_omit(omitidos, None, os.path.basename(path), f"XML inválido: {error}")
                 continue
 
             if not proveedor_ruc and rec["proveedor_ruc"]:
@@ -459,3 +585,5 @@ def run_pipeline(
                         r["detrac_codigo"],
                         r["detrac_importe"]
                     ])
+
+        return {"txt": out_path, "csv": out_omit if omitidos else None, "ruc": ruc11}
@@ -1,3 +1,12 @@
+import gc
+import os
 from proc_detracciones import create_app
 app = create_app()
 
+# Con gunicorn --preload la app se arma una vez en el master; congelar lo que
+# ya existe evita que el GC de cada worker toque esas páginas (copy-on-write)
+gc.freeze()
+
+if __name__ == "__main__":
+    # Solo desarrollo local; en producción se sirve con gunicorn (ver Procfile)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=False, threaded=True)